@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+# end-to-end benchmark: runs telegram-irc-bridge.py against fakebotapi.py and a scripted IRC client, no token or network needed.
+# reports throughput and p50/p99 latency in each direction, and the bridge's CPU time and RSS, for each scenario.
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from fakebotapi import FakeBotApi
+from bridgeloader import bridgeScript
+
+benchGroupId = -100
+benchMarker = re.compile(r"bench(\d+)")
+
+
+def percentile(values, fraction):
+	if not values:
+		return float("nan")
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def freePort():
+	with socket.socket() as probe:
+		probe.bind(("127.0.0.1", 0))
+		return probe.getsockname()[1]
+
+
+def processUsage(pid):
+	# ( cpu seconds, rss bytes, peak rss bytes ) from /proc. linux only
+	with open("/proc/%d/stat" % pid) as statFile:
+		statFields = statFile.read().rsplit(")", 1)[1].split()
+	cpuSeconds = (int(statFields[11]) + int(statFields[12])) / os.sysconf("SC_CLK_TCK")
+	memory = {}
+	with open("/proc/%d/status" % pid) as statusFile:
+		for statusLine in statusFile:
+			if statusLine.startswith(("VmRSS:", "VmHWM:")):
+				memory[statusLine.split(":")[0]] = int(statusLine.split()[1]) * 1024
+	return cpuSeconds, memory.get("VmRSS", 0), memory.get("VmHWM", 0)
+
+
+class ScriptedIrcClient:
+	# a bare-bones IRC bot: logs in, sends lines, and timestamps every benchN marker it sees come back
+	def __init__(self, port):
+		for attempt in range(100):
+			try:
+				self.connection = socket.create_connection(("127.0.0.1", port))
+				break
+			except OSError:
+				time.sleep(0.1)
+		else:
+			raise Exception("bridge never started listening on port %d" % port)
+		self.lines = []  # ( received at, line )
+		self.markersSeen = {}  # marker -> received at
+		self.condition = threading.Condition()
+		threading.Thread(target=self.reader, daemon=True).start()
+
+	def reader(self):
+		pending = b""
+		while True:
+			try:
+				received = self.connection.recv(262144)
+			except OSError:
+				break
+			if not received:
+				break
+			receivedAt = time.monotonic()
+			pending += received
+			lines = pending.split(b"\r\n")
+			pending = lines.pop()
+			with self.condition:
+				for line in lines:
+					line = line.decode("utf-8", "replace")
+					self.lines.append((receivedAt, line))
+					if " PRIVMSG " in line:
+						for marker in benchMarker.findall(line):
+							self.markersSeen.setdefault(int(marker), receivedAt)
+				self.condition.notify_all()
+
+	def send(self, line):
+		self.connection.sendall((line + "\r\n").encode("utf-8"))
+
+	def waitFor(self, predicate, timeout):
+		deadline = time.monotonic() + timeout
+		with self.condition:
+			while not predicate():
+				if time.monotonic() >= deadline:
+					return False
+				self.condition.wait(deadline - time.monotonic())
+			return True
+
+	def waitForLine(self, fragment, timeout, after=0):
+		found = []
+
+		def seen():
+			for receivedAt, line in self.lines[after:]:
+				if fragment in line:
+					found.append(receivedAt)
+					return True
+			return False
+		return found[0] if self.waitFor(seen, timeout) else None
+
+
+class BridgeUnderTest:
+	def __init__(self, options):
+		self.options = options
+		self.workdir = tempfile.mkdtemp(prefix="bridgebench-")
+		self.api = FakeBotApi(latency=options.api_latency / 1000.0).start()
+		self.ircPort = freePort()
+		self.memberIds = list(range(1000, 1000 + options.members))
+		self.nextMarker = 0  # markers are never reused, so stragglers from one scenario can't count towards the next
+		self.writeFiles()
+		self.log = open(os.path.join(self.workdir, "bridge.log"), "w")
+		self.process = subprocess.Popen([sys.executable, bridgeScript], cwd=self.workdir, stdout=self.log, stderr=subprocess.STDOUT)
+		self.irc = ScriptedIrcClient(self.ircPort)
+		self.irc.send("PASS bench")
+		self.irc.send("NICK benchbot")
+		self.irc.send("USER benchbot 0 localhost :bench")
+		if self.irc.waitForLine(" 302 ", 30) is None or not self.api.polled.wait(30):
+			raise Exception("bridge didn't finish starting up, see " + self.log.name)
+
+	def writeFiles(self):
+		with open(os.path.join(self.workdir, "configuration_secrets.ini"), "w") as secretsFile:
+			secretsFile.write("[IRC Configuration]\nListen Address = 127.0.0.1\nListen Port = %d\nListen via SSL = False\nConnection Password = bench\n\n" % self.ircPort)
+			secretsFile.write("[Telegram Configuration]\nSecret Token = 123456:bench\nAPI Base URL = %s\n" % self.api.baseUrl)
+		# the flood limits are there to keep telegram happy. the stand-in doesn't care, and we want to see the bridge itself
+		config = {
+			"telegramGroupMessagesPerMinute": 1000000,
+			"telegramGroupMessageBurst": 1000000,
+			"telegramPrivateMessagesPerSecond": 1000000,
+			"telegramGlobalMessagesPerSecond": 1000000,
+			"telegramOutboxLimit": 1000000,
+			"telegramCoalesceWindowSeconds": self.options.coalesce_window,
+			"logLevel": "WARNING"
+		}
+		with open(os.path.join(self.workdir, "configuration.json"), "w") as configFile:
+			json.dump(config, configFile)
+		# a big group everyone's already a member of, all of them accepting DMs
+		cache = {"users": {}, "groups": {str(benchGroupId): {}}}
+		for memberId in self.memberIds:
+			cache["users"][str(memberId)] = ["member" + str(memberId), True]
+			cache["groups"][str(benchGroupId)][str(memberId)] = memberId % 50 == 0
+		with open(os.path.join(self.workdir, "usercache.json"), "w") as cacheFile:
+			json.dump(cache, cacheFile)
+		self.api.admins[benchGroupId] = [(memberId, "member" + str(memberId)) for memberId in self.memberIds if memberId % 50 == 0]
+
+	def usage(self):
+		return processUsage(self.process.pid)
+
+	def stop(self):
+		self.process.terminate()
+		try:
+			self.process.wait(10)
+		except subprocess.TimeoutExpired:
+			self.process.kill()
+		self.api.stop()
+		self.log.close()
+		if self.options.keep:
+			print("bridge files kept in " + self.workdir)
+		else:
+			shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def waitForSent(api, wanted, timeout):
+	# wait for sendMessage calls carrying every wanted marker. coalesced messages carry several
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		markers = {}
+		for sentAt, chatId, text in list(api.sent):
+			for marker in benchMarker.findall(text):
+				if int(marker) in wanted:
+					markers.setdefault(int(marker), sentAt)
+		if len(markers) >= len(wanted):
+			return markers
+		api.sentEvent.clear()
+		api.sentEvent.wait(0.05)
+	return markers
+
+
+def scenarioTelegramToIrc(bridge, options, linesPerMessage=1):
+	# a group bursting messages at the IRC bot
+	pushedAt = {}
+	marker = bridge.nextMarker
+	startedAt = time.monotonic()
+	for messageIndex in range(options.messages // linesPerMessage):
+		senderId = bridge.memberIds[messageIndex % len(bridge.memberIds)]
+		lines = []
+		for lineIndex in range(linesPerMessage):
+			lines.append("bench%d the quick brown fox jumps over the lazy dog" % marker)
+			pushedAt[marker] = time.monotonic()
+			marker += 1
+		bridge.api.pushMessage(benchGroupId, senderId, "member" + str(senderId), "\n".join(lines))
+	bridge.nextMarker = marker
+	bridge.irc.waitFor(lambda: all(pushed in bridge.irc.markersSeen for pushed in pushedAt), options.timeout)
+	latencies = [bridge.irc.markersSeen[pushed] - pushedAt[pushed] for pushed in pushedAt if pushed in bridge.irc.markersSeen]
+	finishedAt = max([bridge.irc.markersSeen[pushed] for pushed in pushedAt if pushed in bridge.irc.markersSeen] or [time.monotonic()])
+	return {"direction": "TG->IRC", "lines": len(pushedAt), "delivered": len(latencies), "seconds": finishedAt - startedAt, "latencies": latencies}
+
+
+def scenarioMultiline(bridge, options):
+	return scenarioTelegramToIrc(bridge, options, linesPerMessage=10)
+
+
+def scenarioIrcToTelegram(bridge, options, destinations=None):
+	# the IRC bot talking back, to the group or (destinations) to lots of DMs
+	del bridge.api.sent[:]
+	sentAt = {}
+	startedAt = time.monotonic()
+	for marker in range(bridge.nextMarker, bridge.nextMarker + options.messages):
+		destination = "#" + str(benchGroupId) if destinations is None else destinations[len(sentAt) % len(destinations)]
+		sentAt[marker] = time.monotonic()
+		bridge.irc.send("PRIVMSG %s :bench%d the quick brown fox jumps over the lazy dog" % (destination, marker))
+	bridge.nextMarker += options.messages
+	arrivedAt = waitForSent(bridge.api, sentAt, options.timeout)
+	latencies = [arrivedAt[marker] - sentAt[marker] for marker in sentAt if marker in arrivedAt]
+	finishedAt = max(arrivedAt.values() or [time.monotonic()])
+	return {"direction": "IRC->TG", "lines": len(sentAt), "delivered": len(latencies), "seconds": finishedAt - startedAt, "latencies": latencies}
+
+
+def scenarioDmFanOut(bridge, options):
+	return scenarioIrcToTelegram(bridge, options, ["member" + str(memberId) for memberId in bridge.memberIds[:options.dm_users]])
+
+
+def scenarioJoinNames(bridge, options):
+	# JOIN the big group, then NAMES and WHO it again, timing each reply to its end marker
+	latencies = []
+	for command, endNumeric in (("JOIN", " 366 "), ("NAMES", " 366 "), ("WHO", " 315 ")):
+		for repeat in range(options.names_rounds if command != "JOIN" else 1):
+			after = len(bridge.irc.lines)
+			requestedAt = time.monotonic()
+			bridge.irc.send(command + " #" + str(benchGroupId))
+			answeredAt = bridge.irc.waitForLine(endNumeric, options.timeout, after)
+			if answeredAt is not None:
+				latencies.append(answeredAt - requestedAt)
+	rounds = 1 + 2 * options.names_rounds
+	return {"direction": "IRC->IRC", "lines": rounds, "delivered": len(latencies), "seconds": sum(latencies), "latencies": latencies}
+
+
+scenarios = {
+	"names": scenarioJoinNames,
+	"tg-burst": scenarioTelegramToIrc,
+	"tg-multiline": scenarioMultiline,
+	"irc-burst": scenarioIrcToTelegram,
+	"dm-fanout": scenarioDmFanOut
+}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark telegram-irc-bridge.py offline against a fake Bot API.")
+	parser.add_argument("scenario", nargs="*", default=list(scenarios), help="any of: " + ", ".join(scenarios) + " (default: all, names first so the group is joined)")
+	parser.add_argument("--messages", type=int, default=2000, help="lines per message scenario")
+	parser.add_argument("--members", type=int, default=10000, help="members in the benchmark group")
+	parser.add_argument("--dm-users", type=int, default=500, help="distinct users dm-fanout writes to")
+	parser.add_argument("--names-rounds", type=int, default=5, help="NAMES and WHO requests in the names scenario")
+	parser.add_argument("--api-latency", type=float, default=0.0, help="milliseconds the fake API waits before answering")
+	parser.add_argument("--coalesce-window", type=float, default=0.5, help="telegramCoalesceWindowSeconds for the bridge")
+	parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for a scenario to finish")
+	parser.add_argument("--keep", action="store_true", help="keep the bridge's working directory and log")
+	options = parser.parse_args()
+
+	bridge = BridgeUnderTest(options)
+	try:
+		print("%d members, %d lines per scenario, API latency %.1fms, coalesce window %.2fs" % (options.members, options.messages, options.api_latency, options.coalesce_window))
+		print("%-13s %-8s %9s %10s %10s %10s %9s %9s %9s" % ("scenario", "dir", "lines", "lines/s", "p50 ms", "p99 ms", "cpu s", "rss MB", "peak MB"))
+		for scenarioName in options.scenario:
+			cpuBefore = bridge.usage()[0]
+			result = scenarios[scenarioName](bridge, options)
+			cpuAfter, rss, peakRss = bridge.usage()
+			print("%-13s %-8s %4d/%-4d %10.0f %10.2f %10.2f %9.2f %9.1f %9.1f" % (
+				scenarioName, result["direction"], result["delivered"], result["lines"],
+				result["delivered"] / result["seconds"] if result["seconds"] > 0 else float("nan"),
+				percentile(result["latencies"], 0.5) * 1000, percentile(result["latencies"], 0.99) * 1000,
+				cpuAfter - cpuBefore, rss / 1048576.0, peakRss / 1048576.0))
+			time.sleep(0.5)  # let stragglers (admin refreshes, cache flushes) settle before the next one
+	finally:
+		bridge.stop()
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# memory benchmark: the user cache as the bridge used to hold it (revision 2 JSON dicts of string ids, plus the
+# NAMES token and user->groups indexes kept next to it) against the compact CachedUser/CachedGroup representation
+import argparse
+import array
+import json
+import random
+import sys
+import time
+import tracemalloc
+from bisect import bisect_left
+from bridgeloader import loadBridgeDefinitions
+
+bridge = loadBridgeDefinitions(["CachedUser", "CachedGroup", "compactCache", "expandCache", "listMemberTokens", "prefixUsernames"], {
+	"sys": sys,
+	"array": array,
+	"bisect_left": bisect_left,
+	"memberStateUnknown": 0,
+	"memberStateRegular": 1,
+	"memberStateAdmin": 2,
+	"memberStateCodes": {None: 0, False: 1, True: 2},
+	"memberStateValues": (None, False, True),
+	"telegramConfig": {"prefixTelegramUsernamesWithAtSign": False}
+})
+
+
+def buildCacheJson(userCount, groupCount, membershipCount):
+	# a revision 2 usercache.json worth of data: realistic id ranges, a few admins per group, some users in several groups
+	randomizer = random.Random(1)
+	userIds = [str(randomizer.randrange(10 ** 8, 7 * 10 ** 9)) for userIndex in range(userCount)]
+	users = dict((userId, ["user%d" % userIndex, randomizer.random() < 0.1 or None]) for userIndex, userId in enumerate(userIds))
+	groups = {}
+	perGroup = membershipCount // groupCount
+	for groupIndex in range(groupCount):
+		groupMembers = {}
+		for userId in randomizer.sample(userIds, min(perGroup, userCount)):
+			groupMembers[userId] = True if randomizer.random() < 0.01 else (False if randomizer.random() < 0.5 else None)
+		groups[str(-1001000000000 - groupIndex)] = groupMembers
+	return json.dumps({"users": users, "groups": groups})
+
+
+def legacyIndexes(cache):
+	# what rebuildCacheIndexes used to keep next to the dicts
+	usernameIndex = dict((userInfo[0], userId) for userId, userInfo in cache["users"].items())
+	userGroups = {}
+	groupMemberTokens = {}
+	for groupId, groupMembers in cache["groups"].items():
+		memberTokens = groupMemberTokens[groupId] = {}
+		for userId, isAdmin in groupMembers.items():
+			userGroups.setdefault(userId, set()).add(groupId)
+			memberTokens[userId] = ("@" if isAdmin else "+") + cache["users"][userId][0]
+	return usernameIndex, userGroups, groupMemberTokens
+
+
+def compactIndexes(cache):
+	return dict((cachedUser.name, userId) for userId, cachedUser in cache["users"].items())
+
+
+def measure(build):
+	# bytes still allocated once build() has returned, and how long it takes without tracemalloc slowing it down
+	tracemalloc.start()
+	result = build()
+	allocated = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	buildStart = time.perf_counter()
+	build()
+	return result, allocated, time.perf_counter() - buildStart
+
+
+def main():
+	parser = argparse.ArgumentParser(description="memory per 100k memberships, legacy vs compact user cache")
+	parser.add_argument("--users", type=int, default=50000)
+	parser.add_argument("--groups", type=int, default=20)
+	parser.add_argument("--memberships", type=int, default=100000)
+	options = parser.parse_args()
+
+	cacheText = buildCacheJson(options.users, options.groups, options.memberships)
+	groupsText = json.dumps({"users": {}, "groups": json.loads(cacheText)["groups"]})  # memberships on their own
+	memberships = sum(len(groupMembers) for groupMembers in json.loads(cacheText)["groups"].values())
+
+	legacy, legacyBytes, legacySeconds = measure(lambda: json.loads(cacheText))
+	legacyIndex, legacyIndexBytes, legacyIndexSeconds = measure(lambda: legacyIndexes(legacy))
+	legacyGroups, legacyGroupsBytes, legacyGroupsSeconds = measure(lambda: json.loads(groupsText))
+	compact, compactBytes, compactSeconds = measure(lambda: bridge["compactCache"](json.loads(cacheText)))
+	compactIndex, compactIndexBytes, compactIndexSeconds = measure(lambda: compactIndexes(compact))
+	compactGroups, compactGroupsBytes, compactGroupsSeconds = measure(lambda: bridge["compactCache"](json.loads(groupsText)))
+
+	bridge["telegramCache"] = compact
+	largestGroup = max(compact["groups"], key=lambda groupId: len(compact["groups"][groupId]))
+	tokensStart = time.perf_counter()
+	for repeat in range(10):
+		compact["groups"][largestGroup].tokens = None  # as after a membership change
+		bridge["listMemberTokens"](largestGroup)
+	tokensSeconds = (time.perf_counter() - tokensStart) / 10
+	cachedTokensStart = time.perf_counter()
+	for repeat in range(10):
+		bridge["listMemberTokens"](largestGroup)
+	cachedTokensSeconds = (time.perf_counter() - cachedTokensStart) / 10
+	serializeStart = time.perf_counter()
+	expandedText = json.dumps(bridge["expandCache"](compact), separators=(",", ":"))
+	serializeSeconds = time.perf_counter() - serializeStart
+	if json.loads(expandedText) != json.loads(cacheText):
+		raise Exception("compact cache didn't round-trip to the same usercache.json")
+
+	print("%d users, %d groups, %d memberships" % (len(legacy["users"]), len(legacy["groups"]), memberships))
+	print("%-28s %12s %14s %14s %10s" % ("representation", "MB", "B/membership", "MB per 100k", "build s"))
+	for label, allocated, buildSeconds in [
+		("legacy memberships only", legacyGroupsBytes, legacyGroupsSeconds),
+		("compact memberships only", compactGroupsBytes, compactGroupsSeconds),
+		("legacy dicts", legacyBytes, legacySeconds),
+		("legacy dicts + indexes", legacyBytes + legacyIndexBytes, legacySeconds + legacyIndexSeconds),
+		("compact", compactBytes, compactSeconds),
+		("compact + index", compactBytes + compactIndexBytes, compactSeconds + compactIndexSeconds),
+	]:
+		print("%-28s %12.1f %14.1f %14.1f %10.3f" % (label, allocated / 1e6, allocated / memberships, allocated / memberships * 100000 / 1e6, buildSeconds))
+	print("NAMES tokens for the largest group (%d members): %.2fms to build, %.4fms cached" % (len(compact["groups"][largestGroup]), tokensSeconds * 1000, cachedTokensSeconds * 1000))
+	print("serialize to revision 2 JSON: %.3fs (round-trips identically)" % serializeSeconds)
+
+
+if __name__ == "__main__":
+	main()
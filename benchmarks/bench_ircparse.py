@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# microbenchmark: the IRC parser + handler registry against the old split(" ") + elif chain
+import re
+import timeit
+from bridgeloader import loadBridgeDefinitions
+
+bridge = loadBridgeDefinitions(["IrcMessage", "parseIrcTags", "parseIrcLine"], {
+	"re": re,
+	"ircTagUnescapes": {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+})
+parseIrcLine = bridge["parseIrcLine"]
+
+# roughly what a chatty bot sends: mostly PRIVMSG, a few NOTICEs, the odd PING and membership query
+sampleLines = [
+	"PRIVMSG #-1001234567890 :hello there, this is a fairly ordinary line of chat",
+	"PRIVMSG #-1001234567890 :\x01ACTION looks around\x01",
+	"PRIVMSG someuser :a direct message to somebody",
+	"NOTICE #-1001234567890 :[Weather] 14C, partly cloudy",
+	"PRIVMSG #-1001234567890 :another line of list output: item 17 of 40",
+	"PING :telegram.irc.bridge",
+	"@time=2021-01-01T00:00:00.000Z :bot!bot@host PRIVMSG #-1001234567890 :tagged and prefixed",
+	"WHO #-1001234567890",
+	"MODE #-1001234567890 +b",
+	"PRIVMSG #-1001234567890 :yet another line",
+]
+
+# the dispatch order parseIrcMessages used to walk
+legacyCommands = ["PING", "USER", "PONG", "NICK", "PART", "KICK", "REMOVE", "QUIT", "JOIN", "NAMES", "WHO", "MODE", "PRIVMSG", "NOTICE"]
+
+
+def legacyDispatch(rawLine):
+	line = rawLine.split(" ")
+	if line[0] == "PING":
+		return 0
+	elif line[0] == "USER":
+		return 1
+	elif line[0] == "PONG":
+		return 2
+	elif line[0] == "NICK":
+		return 3
+	elif line[0] == "PART":
+		return 4
+	elif line[0] == "KICK":
+		return 5
+	elif line[0] == "REMOVE":
+		return 6
+	elif line[0] == "QUIT":
+		return 7
+	elif line[0] == "JOIN":
+		return 8
+	elif line[0] == "NAMES":
+		return 9
+	elif line[0] == "WHO":
+		return 10
+	elif line[0] == "MODE":
+		return 11
+	elif line[0] == "PRIVMSG":
+		" ".join(line[2:]).lstrip(":")  # what the old PRIVMSG/NOTICE branches had to do to get their text back
+		return 12
+	elif line[0] == "NOTICE":
+		" ".join(line[2:]).lstrip(":")
+		return 13
+	return None
+
+
+handlerRegistry = dict((command, index) for index, command in enumerate(legacyCommands))
+
+
+def registryDispatch(rawLine):
+	message = parseIrcLine(rawLine)
+	return handlerRegistry.get(message.command)
+
+
+def legacyChain(command):
+	# dispatch alone: walk the chain like the old code did
+	for index, legacyCommand in enumerate(legacyCommands):
+		if command == legacyCommand:
+			return index
+	return None
+
+
+def benchmark(name, function, rounds=20000):
+	seconds = min(timeit.repeat(lambda: [function(sampleLine) for sampleLine in sampleLines], number=rounds, repeat=5))
+	linesPerSecond = rounds * len(sampleLines) / seconds
+	print("%-28s %10.0f lines/s  %6.3f us/line" % (name, linesPerSecond, 1000000 / linesPerSecond))
+	return linesPerSecond
+
+
+if __name__ == "__main__":
+	print("%d sample lines, best of 5" % len(sampleLines))
+	legacySpeed = benchmark("split + elif chain (old)", legacyDispatch)
+	registrySpeed = benchmark("parseIrcLine + registry", registryDispatch)
+	print("ratio (new/old): %.2fx" % (registrySpeed / legacySpeed))
+	print("")
+	print("dispatch only, per command position in the old chain:")
+	for command in ["PING", "MODE", "NOTICE", "UNKNOWN"]:
+		chainSeconds = min(timeit.repeat(lambda: legacyChain(command), number=200000, repeat=5))
+		registrySeconds = min(timeit.repeat(lambda: handlerRegistry.get(command), number=200000, repeat=5))
+		print("  %-8s chain %6.3f us   registry %6.3f us" % (command, chainSeconds * 5, registrySeconds * 5))
+	# the old path also got these wrong. the new one doesn't
+	assert parseIrcLine("PRIVMSG #x :two  spaces").params[1] == "two  spaces"
+	assert parseIrcLine("@a=b :nick!u@h privmsg #x :hi").command == "PRIVMSG"
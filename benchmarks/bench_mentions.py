@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# microbenchmark: rewriting IRC text on its way to telegram (@-stripping, username -> mention conversion, code span
+# escaping) against a big user cache, old word-by-user loop vs the single regex pass
+import argparse
+import array
+import random
+import re
+import sys
+import threading
+import timeit
+from bisect import bisect_left
+from bridgeloader import loadBridgeDefinitions
+
+bridge = loadBridgeDefinitions(["rewriteOutboundText", "loadCachedGroup", "CachedUser", "CachedGroup"], {
+	"re": re,
+	"sys": sys,
+	"array": array,
+	"bisect_left": bisect_left,
+	"memberStateUnknown": 0,
+	"memberStateCodes": {None: 0, False: 1, True: 2},
+	"memberStateValues": (None, False, True),
+	"outboundTextPatterns": {},
+	"outboundTextReplacements": {"\x01NEWLINE\x01": "\n", "@": ""},
+	"cacheLock": threading.RLock(),
+	"cacheStore": type("InMemoryStore", (), {"lazy": False})(),
+	"cacheLoadedGroups": set()
+})
+rewriteOutboundText = bridge["rewriteOutboundText"]
+
+
+def legacyRewrite(telegramCache, text, stripAtSigns, convertMentions):
+	# what sendToTelegramChat used to do, word-by-user loop (and its lost rewrite) included
+	if stripAtSigns:
+		text = text.replace("@", "")
+	if convertMentions:
+		temporary = text.split(" ")
+		for word in temporary:
+			for cachedUserId, cachedUser in telegramCache["users"].items():
+				if cachedUser.name == word:
+					word = "@" + word
+		text = " ".join(temporary)
+	return text.replace("\x01NEWLINE\x01", "\n")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="outbound telegram text rewriting against a big user cache")
+	parser.add_argument("--users", type=int, default=50000)
+	parser.add_argument("--members", type=int, default=5000, help="members of the group the messages go to")
+	parser.add_argument("--messages", type=int, default=200)
+	options = parser.parse_args()
+
+	randomizer = random.Random(1)
+	users = dict((100000 + userIndex, bridge["CachedUser"]("user%d" % userIndex)) for userIndex in range(options.users))
+	members = randomizer.sample(sorted(users), options.members)
+	groupId = -1001000000000
+	telegramCache = {"users": users, "groups": {groupId: bridge["CachedGroup"]((userId, None) for userId in members)}}
+	bridge["telegramCache"] = telegramCache
+	bridge["usernameIndex"] = dict((cachedUser.name, userId) for userId, cachedUser in users.items())
+
+	# ordinary chat with the odd name, mention, code and multi-line marker in it
+	vocabulary = "the a to and of is it that for on with this was you deploy build failed passed ok thanks lgtm".split()
+	messages = []
+	for messageIndex in range(options.messages):
+		words = [randomizer.choice(vocabulary) for wordIndex in range(randomizer.randint(5, 25))]
+		for mentionIndex in range(randomizer.randint(0, 2)):
+			words.insert(randomizer.randrange(len(words)), ("@" if randomizer.random() < 0.5 else "") + users[randomizer.choice(members)].name)
+		if randomizer.random() < 0.2:
+			words.append("`make test`\x01NEWLINE\x01exit 0")
+		messages.append(" ".join(words))
+
+	print("%d users, %d in the destination group, %d messages" % (options.users, options.members, options.messages))
+	print("%-48s %14s" % ("rewrite", "us/message"))
+	for label, stripAtSigns, convertMentions, escapeForCode in [
+		("strip @", True, False, False),
+		("strip @ + mentions", True, True, False),
+		("strip @ + mentions + code span escaping", True, True, True),
+	]:
+		bridge["telegramConfig"] = {"stripAllAtSignsFromBotText": stripAtSigns, "forceConvertUsernamesToAtUsernames": convertMentions}
+		passSeconds = min(timeit.repeat(lambda: [rewriteOutboundText(str(groupId), message, escapeForCode) for message in messages], number=5, repeat=3)) / 5
+		print("%-48s %14.1f" % ("new: " + label, passSeconds / len(messages) * 1e6))
+		if not escapeForCode:  # the old code had no escaping at all
+			legacyMessages = messages[:max(1, len(messages) // 20)] if convertMentions else messages  # the old loop is too slow for the full set
+			legacySeconds = min(timeit.repeat(lambda: [legacyRewrite(telegramCache, message, stripAtSigns, convertMentions) for message in legacyMessages], number=1, repeat=3))
+			print("%-48s %14.1f" % ("old: " + label, legacySeconds / len(legacyMessages) * 1e6))
+	bridge["telegramConfig"] = {"stripAllAtSignsFromBotText": True, "forceConvertUsernamesToAtUsernames": True}
+	print("\nexample:\n  in:  %r\n  out: %r" % (messages[0], rewriteOutboundText(str(groupId), messages[0], True)))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,20 @@
+# helper for the benchmarks: pulls individual functions and classes out of telegram-irc-bridge.py
+# without running its startup code (which wants a bot token, a config and an IRC socket).
+import ast
+import os
+
+bridgeScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "telegram-irc-bridge.py")
+
+
+def loadBridgeDefinitions(names, namespace=None):
+	# exec just the named top-level defs into namespace. anything they use at call time (globals, printLog...) is up to the caller
+	if namespace is None:
+		namespace = {}
+	with open(bridgeScript, "r") as filehandle:
+		tree = ast.parse(filehandle.read(), bridgeScript)
+	wanted = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names]
+	missing = set(names) - set(node.name for node in wanted)
+	if missing:
+		raise Exception("not found in bridge script: " + ", ".join(sorted(missing)))
+	exec(compile(ast.Module(body=wanted, type_ignores=[]), bridgeScript, "exec"), namespace)
+	return namespace
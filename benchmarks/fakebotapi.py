@@ -0,0 +1,108 @@
+# a stand-in for the telegram Bot API, good enough to run the bridge against offline.
+# serves getMe, getUpdates (long polling), sendMessage and getChatAdministrators, plus a few calls the bridge
+# makes in passing, with an optional artificial delay per method. point the bridge's "API Base URL" at baseUrl.
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+
+	def do_POST(self):
+		api = self.server.api
+		body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+		if "json" in self.headers.get("Content-Type", ""):
+			params = json.loads(body or b"{}")
+		else:
+			params = dict((key, values[0]) for key, values in parse_qs(body.decode("utf-8")).items())
+		method = self.path.rsplit("/", 1)[-1]
+		delay = api.latencies.get(method, api.latency)
+		if delay:
+			time.sleep(delay)
+		api.calls[method] = api.calls.get(method, 0) + 1
+		handler = getattr(api, "api_" + method, None)
+		result = handler(params) if handler is not None else True
+		reply = json.dumps({"ok": True, "result": result}).encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(reply)))
+		self.end_headers()
+		self.wfile.write(reply)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class FakeBotApi:
+	def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+		self.latency = latency  # seconds added to every call...
+		self.latencies = {}  # ... unless overridden here per method, like {"sendMessage": 0.05}
+		self.admins = {}  # chat id -> [ ( user id, username ), ... ]
+		self.sent = []  # ( received at, chat id, text ) for every sendMessage
+		self.sentEvent = threading.Event()
+		self.polled = threading.Event()  # set once the bridge has started fetching updates
+		self.calls = {}
+		self.updates = []
+		self.nextUpdateId = 1
+		self.nextMessageId = 1
+		self.updatesCondition = threading.Condition()
+		self.server = ThreadingHTTPServer((host, port), FakeBotApiHandler)
+		self.server.daemon_threads = True
+		self.server.api = self
+		self.baseUrl = "http://%s:%d/bot" % self.server.server_address[:2]
+
+	def start(self):
+		threading.Thread(target=self.server.serve_forever, name="fakeBotApi", daemon=True).start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def pushMessage(self, chatId, userId, username, text, chatType="group"):
+		# queue an incoming message for the bridge's next getUpdates
+		with self.updatesCondition:
+			update = {"update_id": self.nextUpdateId, "message": {
+				"message_id": self.nextMessageId,
+				"date": int(time.time()),
+				"chat": {"id": chatId, "type": chatType},
+				"from": {"id": userId, "is_bot": False, "first_name": username, "username": username},
+				"text": text
+			}}
+			self.nextUpdateId += 1
+			self.nextMessageId += 1
+			self.updates.append(update)
+			self.updatesCondition.notify_all()
+			return update["update_id"]
+
+	def api_getMe(self, params):
+		return {"id": 1, "is_bot": True, "first_name": "bench", "username": "benchbot"}
+
+	def api_getUpdates(self, params):
+		self.polled.set()
+		offset = int(params.get("offset") or 0)
+		deadline = time.monotonic() + float(params.get("timeout") or 0)
+		with self.updatesCondition:
+			if offset:
+				self.updates = [update for update in self.updates if update["update_id"] >= offset]  # confirmed, forget them
+			while not self.updates and time.monotonic() < deadline:
+				self.updatesCondition.wait(deadline - time.monotonic())
+			return self.updates[:int(params.get("limit") or 100)]
+
+	def api_sendMessage(self, params):
+		self.sent.append((time.monotonic(), int(params["chat_id"]), params.get("text", "")))
+		self.sentEvent.set()
+		self.nextMessageId += 1
+		chatId = int(params["chat_id"])
+		return {"message_id": self.nextMessageId, "date": int(time.time()), "chat": {"id": chatId, "type": "group" if chatId < 0 else "private"}, "text": params.get("text", "")}
+
+	def api_getChatAdministrators(self, params):
+		return [{"user": {"id": userId, "is_bot": False, "first_name": username, "username": username}, "status": "administrator"} for userId, username in self.admins.get(int(params["chat_id"]), [])]
+
+	def api_getChatMemberCount(self, params):
+		return len(self.admins.get(int(params["chat_id"]), [])) + 1
+
+	api_getChatMembersCount = api_getChatMemberCount
@@ -2,26 +2,126 @@
 import sys
 import os.path
 import logging
-import socket
+import asyncio
 import json
 import signal
+import re
 import configparser
-from time import sleep
-from datetime import datetime
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from telegram import Bot, ParseMode
+import sqlite3
+import threading
+import queue
+import hmac
+import zlib
+import array
+import logging.handlers
+from collections import deque
+from time import monotonic, time, sleep
+from bisect import bisect_left
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telegram.ext import Updater, CommandHandler, MessageHandler, ChatMemberHandler, TypeHandler, DispatcherHandlerStop, Filters
+from telegram import Bot, ParseMode, Update
+from telegram.error import Unauthorized, RetryAfter
+from telegram.utils.request import Request
 
 # telegram-irc-bridge
 bridgeVersion = "0.1.3.2"  # don't comment this out
+bridgeStartedAt = monotonic()  # uptime and time-to-first-message are measured from here
 # by rglx
 # simulates a simple IRC server for connecting an IRC bot to a telegram bot account, with some limited functionality and controls therein.
 
 
-def printLog(channel="Debug", message="empty"):
+class BridgeLogFormatter(logging.Formatter):  # the classic "[timestamp] [channel] message" look, for library records too
+	def format(self, record):
+		if not hasattr(record, "channel"):
+			record.channel = "*" + record.name + " " + record.levelname
+		return super().format(record)
+
+
+class BridgeJsonLogFormatter(logging.Formatter):  # one JSON object per line, for log shippers
+	def format(self, record):
+		entry = {
+			"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+			"level": record.levelname,
+			"category": getattr(record, "category", record.name),
+			"channel": getattr(record, "channel", record.name),
+			"message": record.getMessage()
+		}
+		if record.exc_info:
+			entry["exception"] = self.formatException(record.exc_info)
+		return json.dumps(entry, ensure_ascii=False)
+
+
+class BridgeQueueHandler(logging.handlers.QueueHandler):
+	def prepare(self, record):  # hand records over untouched, so %-formatting happens on the listener thread instead of ours
+		return record
+
+
+def resolveLogChannel(channel):  # "Cache WARNING" -> (bridge.Cache logger, WARNING). chat lines get their own category
+	words = channel.split()
+	level = logging.INFO
+	if channel.startswith(" * "):
+		return logging.getLogger("bridge.Chat"), level
+	if words and words[-1].upper() in logLevelWords:
+		level = logLevelWords[words.pop().upper()]
+		if words and words[0] in ("FATAL", "CRITICAL"):
+			words = []
+			level = logging.CRITICAL
+	return logging.getLogger("bridge." + (words[0] if words else "System")), level
+
+
+def printLog(channel="Debug", message="empty", *args):
 	# specialized log-printer that makes our logs ~fancy~
-	now = datetime.now()
-	timestamp = now.strftime("%m/%d/%Y %H:%M:%S")
-	print("[" + str(timestamp) + "] [" + channel + "] " + message)
+	# timestamps, formatting and the actual printing happen on the log listener thread; pass values as %-args so they're only formatted if the line gets shown
+	resolved = logChannels.get(channel)
+	if resolved is None:
+		resolved = logChannels[channel] = resolveLogChannel(channel)
+	logger, level = resolved
+	if level == logging.INFO and message.startswith("WARNING!"):
+		level = logging.WARNING
+	if logger.isEnabledFor(level):
+		logger.handle(logger.makeRecord(logger.name, level, "", 0, message, args, None, extra={"channel": channel, "category": logger.name[7:]}))
+
+
+def configureLogging(config):  # apply configuration.json's logging settings to the listener and loggers
+	global logListener
+	try:
+		if config["logFile"]:
+			handler = logging.FileHandler(config["logFile"], encoding="utf-8")
+		else:
+			handler = logging.StreamHandler(sys.stdout)
+	except OSError as error:
+		printLog("Config ERROR", "Could not open log file %s: %s", config["logFile"], error)
+		return
+	if config["logFormat"] == "json":
+		handler.setFormatter(BridgeJsonLogFormatter())
+	else:
+		handler.setFormatter(BridgeLogFormatter(logFormat, logDateFormat))
+	try:
+		logging.getLogger("bridge").setLevel(str(config["logLevel"]).upper())
+		for category, level in config["logCategoryLevels"].items():
+			logging.getLogger("bridge." + category).setLevel(str(level).upper())
+	except ValueError as error:
+		printLog("Config WARNING", "Ignoring bad log level: %s", error)
+	logListener.stop()  # drains whatever was queued through the old handler first
+	logListener = logging.handlers.QueueListener(logQueue, handler)
+	logListener.start()
+
+
+# logging goes through a queue so that nobody but the listener thread ever waits on stdout.
+# this starts out printing everything at INFO; configureLogging() takes over once the config is loaded.
+logFormat = "[%(asctime)s] [%(channel)s] %(message)s"
+logDateFormat = "%m/%d/%Y %H:%M:%S"
+logLevelWords = {"DEBUG": logging.DEBUG, "WARNING": logging.WARNING, "ERROR": logging.ERROR}
+logChannels = {}
+logQueue = queue.SimpleQueue()
+logging.getLogger().addHandler(BridgeQueueHandler(logQueue))
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger("bridge").setLevel(logging.INFO)
+logStartupHandler = logging.StreamHandler(sys.stdout)
+logStartupHandler.setFormatter(BridgeLogFormatter(logFormat, logDateFormat))
+logListener = logging.handlers.QueueListener(logQueue, logStartupHandler)
+logListener.start()
 
 
 printLog("System", "Importing dependencies...")
@@ -37,7 +137,6 @@ def bridge_alltext(update, context):
 	sourceUserName = str(update.effective_user.username).lower()
 	sourceUserId = str(update.effective_user.id)
 	sourceChatId = str(update.effective_chat.id)
-	adminsList = None
 	messageType = None
 
 	if sourceUserName == "None" or sourceUserName is None:  # ignore messages from @-less usernames
@@ -49,7 +148,7 @@ def bridge_alltext(update, context):
 		messageType = "DM w/"
 	elif int(sourceChatId) < 0:  # groups are negative numbers
 		toIrcDestination = "#" + str(update.effective_chat.id)  # translate to the channel's "name"
-		adminsList = update.effective_chat.get_administrators()
+		requestAdminRefresh(sourceChatId)  # admin list is refreshed in the background, never here
 		messageType = "Chat"
 	else:
 		# message going to a non-group location that ISN'T a DM with that exact user
@@ -75,48 +174,48 @@ def bridge_alltext(update, context):
 		cacheGroup = sourceChatId
 
 	foundNewUserStatus, foundNewUserAdminStatus = saveUserToCache(sourceUserId, sourceUserName, cacheGroup, None, None)
-	if adminsList is not None:
-		for chatMember in adminsList:
-			if chatMember.user.username is not None:
-				foundNewListedUserStatus, foundNewListedAdminStatus = saveUserToCache(str(chatMember.user.id), str(chatMember.user.username).lower(), cacheGroup, True, None)
-				if foundNewListedUserStatus and toIrcDestination.startswith("#"):
-					sendToIrc(":" + prefixUsernames() + str(chatMember.user.username).lower() + "!" + str(chatMember.user.id) + "@telegram.irc.bridge" + " JOIN " + toIrcDestination)
-				if foundNewListedAdminStatus:
-					sendToIrc(":telegram.irc.bridge MODE " + toIrcDestination + " +o-v " + prefixUsernames() + chatMember.user.username + " " + prefixUsernames() + str(chatMember.user.username).lower())
-				elif foundNewListedAdminStatus is False:
-					sendToIrc(":telegram.irc.bridge MODE " + toIrcDestination + " -o+v " + prefixUsernames() + chatMember.user.username + " " + prefixUsernames() + str(chatMember.user.username).lower())
-
-	# this is a new user talking, let's make sure the bot updates its userlist with the new information.
-	if foundNewUserStatus and toIrcDestination.startswith("#"):
-		sendToIrc(":" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "@telegram.irc.bridge" + " JOIN " + toIrcDestination)
-
-	# update the bot on our new operator status
-	if foundNewUserAdminStatus is True:
-		sendToIrc(":telegram.irc.bridge MODE " + toIrcDestination + " +o-v " + prefixUsernames() + sourceUserName + " " + prefixUsernames() + sourceUserName)
-	elif foundNewUserAdminStatus is False:
-		sendToIrc(":telegram.irc.bridge MODE " + toIrcDestination + " -o+v " + prefixUsernames() + sourceUserName + " " + prefixUsernames() + sourceUserName)
 
+	# a new user talking joins the bot's userlist, and any change in operator status goes along with it
+	if toIrcDestination.startswith("#") and (foundNewUserStatus or foundNewUserAdminStatus is not None):
+		sendToIrcChannel(toIrcDestination, membershipChangeLines(
+			toIrcDestination,
+			[(sourceUserId, sourceUserName)] if foundNewUserStatus else [],
+			[sourceUserName] if foundNewUserAdminStatus is True else [],
+			[sourceUserName] if foundNewUserAdminStatus is False else []
+		))
+
+	logChannel = " * TG  " + messageType + " " + toIrcDestination
+	messageSentAt = update.effective_message.date.timestamp() if update.effective_message.date is not None else time()
 	if "\n" in toIrcText:  # multiline text incoming
 		# uh oh! multiline! time to split and parse
 		if toIrcText.startswith("/me "):  # incoming multiline action
 			toIrcMultilineTexts = " ".join(toIrcText.split(" ")[1:]).split("\n")  # chop off first word because it's the actual /me command
 			for multiLineText in toIrcMultilineTexts:
 				if multiLineText != "" or multiLineText is not None:
-					printLog(" * TG  " + messageType + " " + toIrcDestination, " * " + prefixUsernames() + sourceUserName + "!" + sourceUserId + "|M " + multiLineText)
-					sendToIrc(":" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "@telegram.irc.bridge" + " PRIVMSG " + toIrcDestination + " :\x01ACTION " + multiLineText + "\x01")
+					printLog(logChannel, " * %s%s!%s|M %s", prefixUsernames(), sourceUserName, sourceUserId, multiLineText)
+					sendChatLineToIrc(toIrcDestination, ":" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "@telegram.irc.bridge" + " PRIVMSG " + toIrcDestination + " :\x01ACTION " + multiLineText + "\x01", messageSentAt)
 
 		else:  # regular multiline text incoming
 			toIrcMultilineTexts = toIrcText.split("\n")
 			for multiLineText in toIrcMultilineTexts:
 				if multiLineText != "" or multiLineText is not None:
-					printLog(" * TG  " + messageType + " " + toIrcDestination, "<" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "|M> " + multiLineText)
-					sendToIrc(":" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "@telegram.irc.bridge" + " PRIVMSG " + toIrcDestination + " :" + multiLineText)
+					printLog(logChannel, "<%s%s!%s|M> %s", prefixUsernames(), sourceUserName, sourceUserId, multiLineText)
+					sendChatLineToIrc(toIrcDestination, ":" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "@telegram.irc.bridge" + " PRIVMSG " + toIrcDestination + " :" + multiLineText, messageSentAt)
 
 	else:  # normal non-multiline text
 		if toIrcText.startswith("/me "):  # incoming action
 			toIrcText = "\x01ACTION " + " ".join(toIrcText.split(" ")[1:]) + "\x01"  # remove /me, add CTCP ACTION
-		printLog(" * TG  " + messageType + " " + toIrcDestination, "<" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "> " + toIrcText)
-		sendToIrc(":" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "@telegram.irc.bridge" + " PRIVMSG " + toIrcDestination + " :" + toIrcText)
+		printLog(logChannel, "<%s%s!%s> %s", prefixUsernames(), sourceUserName, sourceUserId, toIrcText)
+		sendChatLineToIrc(toIrcDestination, ":" + prefixUsernames() + sourceUserName + "!" + sourceUserId + "@telegram.irc.bridge" + " PRIVMSG " + toIrcDestination + " :" + toIrcText, messageSentAt)
+
+	countMetric("bridge_messages_total", 'direction="telegram_to_irc"')
+	global bridgeFirstMessageSeconds
+	if bridgeFirstMessageSeconds is None:
+		bridgeFirstMessageSeconds = monotonic() - bridgeStartedAt
+		printLog("System", "First message bridged %.2fs after startup", bridgeFirstMessageSeconds)
+	if update.effective_message.date is not None and toIrcDestination not in ircReplayBuffers:
+		# observed by each recipient once its flushOutput has actually written the lines
+		ircLoop.call_soon_threadsafe(fanOutLatencyMark, toIrcDestination, messageSentAt)
 
 
 def bridge_controlcommand(update, context):
@@ -136,7 +235,7 @@ def bridge_controlcommand(update, context):
 		# /start command issued, allowing the bridge to convey DMs between bot and user
 		printLog("Control", sourceUserName + " enabled DMs with bridge client.")
 		saveUserToCache(sourceUserId, sourceUserName, None, None, True)
-		sendToTelegramChat(sourceChatId, "`[Bridge Notice]` PMs will now be conducted between you and the bot\n Use /stop, or block the bot to disable this", True)
+		sendToTelegramChat(sourceChatId, "`[Bridge Notice]` PMs will now be conducted between you and the bot\n Use /stop, or block the bot to disable this", True, telegramPriorityControl)
 	if sourceText.startswith("/stop"):
 		# /start command issued, allowing the bridge to convey DMs between bot and user
 		saveUserToCache(sourceUserId, sourceUserName, None, None, False)
@@ -148,111 +247,964 @@ def bridge_controlcommand(update, context):
 		printLog("Debug", "test")
 
 
+def bridge_chatmember(update, context):
+	# someone's membership or rights changed somewhere (possibly our own). the admin list we have cached is stale now.
+	memberUpdate = update.chat_member or update.my_chat_member
+	if memberUpdate is None or memberUpdate.chat.id >= 0:
+		return None
+	printLog("Cache", "Membership change in TGG %s, scheduling admin list refresh", memberUpdate.chat.id)
+	requestAdminRefresh(str(memberUpdate.chat.id), True)
+
+
+def bridge_routeupdate(update, context):
+	# the first handler every update meets, on the dispatcher's own thread. queues the update for the telegramInbound workers
+	# by chat and stops the dispatcher there. a worker then runs it back through the dispatcher, and this lets it pass
+	global inboundUpdatesQueued
+	if getattr(inboundWorkerState, "dispatching", False):
+		return None
+	chatKey = update.effective_chat.id if update.effective_chat is not None else None  # chatless updates share one queue
+	with inboundCondition:
+		chatQueue = inboundChats.get(chatKey)
+		if chatQueue is None:  # nobody's working on this chat, so it can be picked up straight away
+			chatQueue = inboundChats[chatKey] = deque()
+			inboundReadyChats.append(chatKey)
+			inboundCondition.notify()
+		chatQueue.append((update, monotonic()))
+		inboundUpdateOrder.append(update.update_id)
+		inboundUpdatesQueued += 1
+	raise DispatcherHandlerStop()
+
+
+def telegramInbound():
+	# background worker, telegramInboundWorkers of them. runs updates through the handlers, different chats in parallel and
+	# each chat strictly one update after the other, so IRC sees a group's JOIN/MODE and chat lines in the order they happened
+	global inboundUpdatesQueued, inboundUpdatesInFlight
+	inboundWorkerState.dispatching = True
+	while True:
+		with inboundCondition:
+			while not inboundReadyChats:
+				inboundCondition.wait()
+			chatKey = inboundReadyChats.popleft()
+			update, queuedAt = inboundChats[chatKey].popleft()
+			inboundUpdatesQueued -= 1
+			inboundUpdatesInFlight += 1
+		handleStart = monotonic()
+		observeMetric("bridge_telegram_update_wait_seconds", handleStart - queuedAt)
+		try:
+			dispatcher.process_update(update)
+		finally:
+			observeMetric("bridge_telegram_update_seconds", monotonic() - handleStart)
+			completedUpdateId = None
+			with inboundCondition:
+				inboundUpdatesInFlight -= 1
+				if inboundChats[chatKey]:
+					inboundReadyChats.append(chatKey)
+					inboundCondition.notify()
+				else:
+					del inboundChats[chatKey]
+				# chats finish out of order. only updates with nothing older still pending count towards the saved offset
+				inboundFinishedIds.add(update.update_id)
+				while inboundUpdateOrder and inboundUpdateOrder[0] in inboundFinishedIds:
+					completedUpdateId = inboundUpdateOrder.popleft()
+					inboundFinishedIds.discard(completedUpdateId)
+			if completedUpdateId is not None:
+				recordUpdateOffset(completedUpdateId)
+
+
+def recordUpdateOffset(updateId):
+	# the offset is saved with the cache, so a restart resumes after the last update that was completely handled
+	global cacheOffsetDirty
+	with cacheLock:
+		if updateId > telegramCache.get("lastUpdateId", 0):
+			telegramCache["lastUpdateId"] = updateId
+			cacheOffsetDirty = True
+
+
 def saveUserToCache(userId, storedName, groupId=None, adminOnSpecificGroup=None, directMessagesAllowed=None):
-	# correctly store these three as strings
-	userId = str(userId)
+	# ids are kept as integers in memory, whatever form the caller has them in
+	userId = int(userId)
 	storedName = str(storedName).lower()
 	if groupId == "None" or groupId is None:
 		groupId = None
 	else:
-		groupId = str(groupId)
+		groupId = int(groupId)
 	if storedName is None or userId is None:  # sanity checks
 		raise Exception("inputted userId or user/firstname was none.")
-	cacheChanged = False  # not returned, but used to determine if the cache should be written
-	newUserInChannel = False  # true = this user is new to this particular chat, false = user existed already
-	adminStatusChanged = None  # true = is now admin, false = no longer admin, None = unchanged
-
-	# step one, check if we have seen this user before now
-	if userId not in telegramCache["users"].keys():
-		printLog("Cache", "Created empty user entry for " + userId)
-		telegramCache["users"][userId] = [None, None]  # create empty entry for userid/name/PmsEnabled info
-		cacheChanged = True
-		# we don't need to check if this is a new user in the channel or mark it as such because that's done below.
-
-	# stored name doesn't match what we already have.
-	if storedName != telegramCache["users"][userId][0] and storedName != "None":
-		printLog("Cache", "updated username user entry for " + userId)
-		telegramCache["users"][userId][0] = storedName
-		cacheChanged = True
-
-	if directMessagesAllowed is not None:
-		# dmsAllowed possibly changing!
-		if directMessagesAllowed != telegramCache["users"][userId][1]:
-			printLog("Cache", "updated dmAllowed state for " + userId)
-			# incoming information differs, change it and make sure the cache is saved.
-			telegramCache["users"][userId][1] = directMessagesAllowed
-			cacheChanged = True
-
-	if groupId is not None:
-		# printLog("Cache DEBUG","group cache updating for TGG "+groupId)
-		if groupId not in telegramCache["groups"].keys():
-			printLog("Cache", "added empty group entry for TGG " + groupId)
-			# new channel! create dict for members and admin statuses therein
-			telegramCache["groups"][groupId] = {}
+	with cacheLock:  # handlers and the admin refresher can both land here at once
+		if groupId is not None:
+			loadCachedGroup(groupId)
+		loadCachedUser(userId)
+		cacheChanged = False  # not returned, but used to determine if the cache should be written
+		newUserInChannel = False  # true = this user is new to this particular chat, false = user existed already
+		adminStatusChanged = None  # true = is now admin, false = no longer admin, None = unchanged
+
+		# step one, check if we have seen this user before now
+		cachedUser = telegramCache["users"].get(userId)
+		if cachedUser is None:
+			printLog("Cache", "Created empty user entry for %s", userId)
+			cachedUser = telegramCache["users"][userId] = CachedUser()  # create empty entry for userid/name/PmsEnabled info
 			cacheChanged = True
-		if userId not in telegramCache["groups"][groupId].keys():
-			printLog("Cache", "new user " + userId + " detected in " + groupId)
-			# new user found in our channel. populate information
-			telegramCache["groups"][groupId][userId] = None  # default is None because we havent gathered that information yet
-			# and pass that information back outwards to our calling code
-			newUserInChannel = True
+			# we don't need to check if this is a new user in the channel or mark it as such because that's done below.
+
+		# stored name doesn't match what we already have. (str(None).lower() is how callers say "don't touch the name")
+		if storedName != cachedUser.name and storedName != "none":
+			printLog("Cache", "updated username user entry for %s", userId)
+			if usernameIndex.get(cachedUser.name) == userId:  # don't unlink a name somebody else has since taken
+				del usernameIndex[cachedUser.name]
+			cachedUser = telegramCache["users"][userId] = CachedUser(storedName, cachedUser.dmAllowed)  # replaced, never changed in place, so flush snapshots can share them
+			usernameIndex[cachedUser.name] = userId  # newest holder of a username wins
+			for cachedGroup in telegramCache["groups"].values():  # renames are rare. their groups' NAMES tokens are rebuilt on next use
+				if cachedGroup.tokens is not None and userId in cachedGroup:
+					cachedGroup.tokens = None
 			cacheChanged = True
 
-		# user is definitely either an admin or not an admin, not 'unknown'
-		if adminOnSpecificGroup is not None:
-			if telegramCache["groups"][groupId][userId] is None or telegramCache["groups"][groupId][userId] == "None":
-				telegramCache["groups"][groupId][userId] = adminOnSpecificGroup
-				printLog("Cache", "adminstate changed to " + str(adminOnSpecificGroup) + " on " + userId + " in " + groupId)
-				adminStatusChanged = adminOnSpecificGroup
+		if directMessagesAllowed is not None:
+			# dmsAllowed possibly changing!
+			if directMessagesAllowed != cachedUser.dmAllowed:
+				printLog("Cache", "updated dmAllowed state for %s", userId)
+				# incoming information differs, change it and make sure the cache is saved.
+				cachedUser = telegramCache["users"][userId] = CachedUser(cachedUser.name, directMessagesAllowed)
+				cacheChanged = True
+
+		if groupId is not None:
+			# printLog("Cache DEBUG","group cache updating for TGG "+groupId)
+			cachedGroup = telegramCache["groups"].get(groupId)
+			if cachedGroup is None:
+				printLog("Cache", "added empty group entry for TGG %s", groupId)
+				# new channel! create the member list and admin states therein
+				cachedGroup = telegramCache["groups"][groupId] = CachedGroup()
+				cacheChanged = True
+			if cachedGroup.add(userId):  # default admin state is None because we havent gathered that information yet
+				printLog("Cache", "new user %s detected in %s", userId, groupId)
+				# and pass that information back outwards to our calling code
+				newUserInChannel = True
 				cacheChanged = True
-	# else:
-		# printLog("Cache DEBUG", "skipping group cache actions as function was not called with groupId")
 
-	# only write the cache if it's actually been changed. otherwise we're doing excessive disk writes for no reason
-	if cacheChanged:
-		saveCache(telegramCache)
-	return newUserInChannel, adminStatusChanged
+			# user is definitely either an admin or not an admin, not 'unknown'
+			if adminOnSpecificGroup is not None:
+				if cachedGroup.isAdmin(userId) != adminOnSpecificGroup:
+					cachedGroup.setAdmin(userId, adminOnSpecificGroup)
+					printLog("Cache", "adminstate changed to %s on %s in %s", adminOnSpecificGroup, userId, groupId)
+					adminStatusChanged = adminOnSpecificGroup
+					cacheChanged = True
+		# else:
+			# printLog("Cache DEBUG", "skipping group cache actions as function was not called with groupId")
+
+		# only mark the cache dirty if it's actually been changed. the persister thread takes care of writing it out
+		if cacheChanged:
+			markCacheDirty(userId, groupId)
+		return newUserInChannel, adminStatusChanged
+
+
+def rebuildCacheIndexes():
+	# build the username lookup that sits next to the loaded cache. saveUserToCache keeps it up to date after this
+	with cacheLock:
+		usernameIndex.clear()
+		for cachedUserId, cachedUser in telegramCache["users"].items():
+			if cachedUser.name is not None and cachedUser.name != "none":
+				usernameIndex[cachedUser.name] = cachedUserId
+	printLog("Cache", "Indexed " + str(len(usernameIndex)) + " usernames in " + str(len(telegramCache["groups"])) + " groups.")
+
+
+def listMemberTokens(groupId):
+	# cacheLock held. [ ( userId, "@name" or "+name" ), ... ] for everyone in a group, ready to go into a NAMES or WHO reply.
+	# built once and kept on the CachedGroup until its membership, an admin state or a member's name changes
+	cachedGroup = telegramCache["groups"].get(groupId)
+	if cachedGroup is None:
+		return []
+	if cachedGroup.tokens is not None:
+		return cachedGroup.tokens
+	cachedUsers = telegramCache["users"]
+	namePrefix = prefixUsernames()
+	memberTokens = []
+	for memberUserId, memberState in zip(cachedGroup.members, cachedGroup.states):
+		cachedUser = cachedUsers.get(memberUserId)
+		if cachedUser is None or cachedUser.name is None or cachedUser.name == "none":  # @-less users can't be represented on IRC
+			continue
+		memberTokens.append((memberUserId, ("@" if memberState == memberStateAdmin else "+") + namePrefix + cachedUser.name))
+	cachedGroup.tokens = memberTokens
+	return memberTokens
+
+
+def lookupUserByName(userName):
+	# returns ( userId, directMessagesAllowed ) for a (case-insensitive) username, or ( None, None ) if we've never seen it
+	with cacheLock:
+		cachedUserId = usernameIndex.get(str(userName).lower())
+		if cachedUserId is None and cacheStore.lazy:  # not in the hot set, maybe the store has them
+			storedUser = cacheStore.loadUserByName(str(userName).lower())
+			if storedUser is not None and storedUser[0] not in telegramCache["users"]:  # (if they're already loaded, the store's name is stale)
+				addCachedUser(storedUser[0], storedUser[1])
+				cachedUserId = usernameIndex.get(str(userName).lower())
+		if cachedUserId is None:
+			return None, None
+		return cachedUserId, telegramCache["users"][cachedUserId].dmAllowed
+
+
+def addCachedUser(userId, storedUser):
+	# cacheLock held. put a user fetched from the store into the hot set
+	telegramCache["users"][userId] = storedUser
+	if storedUser.name is not None and storedUser.name != "none":
+		usernameIndex.setdefault(storedUser.name, userId)
+
+
+def loadCachedUser(userId):
+	# cacheLock held. make sure a user the store knows about is in the hot set before it's looked at
+	if cacheStore.lazy and userId not in telegramCache["users"]:
+		storedUser = cacheStore.loadUser(userId)
+		if storedUser is not None:
+			addCachedUser(userId, storedUser)
+
+
+def loadCachedGroup(groupId):
+	# cacheLock held. the first time a group is needed, pull its members, their users and admin states into the hot set
+	if not cacheStore.lazy or groupId in cacheLoadedGroups:
+		return
+	cacheLoadedGroups.add(groupId)
+	storedMembers, storedUsers = cacheStore.loadGroup(groupId)
+	if not storedMembers:
+		return
+	for storedUserId, storedUser in storedUsers.items():
+		if storedUserId not in telegramCache["users"]:
+			addCachedUser(storedUserId, storedUser)
+	cachedGroup = telegramCache["groups"].get(groupId)
+	if cachedGroup is None:
+		telegramCache["groups"][groupId] = CachedGroup(storedMembers.items())
+	else:  # members seen before the store was asked. what's in memory is newer
+		for storedUserId, storedAdmin in storedMembers.items():
+			if cachedGroup.add(storedUserId):
+				cachedGroup.setAdmin(storedUserId, storedAdmin)
+	printLog("Cache", "Loaded %d members of TGG %s from the store", len(storedMembers), groupId)
+
+
+def requestAdminRefresh(groupId, force=False, priority=None):
+	# queue a group's admin list to be (re)fetched by the refresher threads if it's missing or older than the TTL.
+	# cheap enough to be called for every single group message. telegramPriorityControl jumps the queue, e.g. for a JOIN
+	# that's waiting on it, even if the group is already queued behind the startup warm-up
+	if int(groupId) >= 0:  # users and DMs have no admins to fetch
+		return False
+	groupId = str(groupId)
+	if priority is None:
+		priority = telegramPriorityBulk
+	with adminCacheLock:
+		cachedAdmins = adminCache.get(groupId)
+		if not force and cachedAdmins is not None and monotonic() - cachedAdmins[0] < telegramConfig["adminCacheTtlSeconds"]:
+			return False
+		if groupId in adminRefreshPending and priority >= adminRefreshPending[groupId]:
+			return False
+		adminRefreshPending[groupId] = priority
+	adminRefreshQueue.put((priority, monotonic(), groupId))
+	return True
+
+
+def warmUpGroups():
+	# startup. queue every group we know of, so their admins are in the cache (and on IRC) before anyone asks for NAMES
+	groupIds = [groupId for groupId in cacheStore.listGroupIds() if groupId < 0]
+	for groupId in groupIds:
+		requestAdminRefresh(groupId)
+	printLog("Cache", "Warming up %d known groups in the background", len(groupIds))
+
+
+def paceAdminRefresh():
+	# refresher threads share one allowance of telegram API calls, so a warm-up of many groups doesn't trip telegram's limits
+	while True:
+		with adminCacheLock:
+			now = monotonic()
+			refreshDelay = adminRefreshBucket.delay(now)
+			if refreshDelay <= 0:
+				adminRefreshBucket.take(now)
+				return
+		sleep(refreshDelay)
 
 
-def sendToIrc(string):
-	global conn
+def fetchFromTelegram(method, call):
+	# one paced API call for the refresher threads. None if it failed
+	paceAdminRefresh()
+	callStart = monotonic()
 	try:
-		conn.sendall((string + '\r\n').encode('utf-8'))
-	except:
-		shutdownBridge(None, "IRC ERROR", "Connection was lost or interrupted! Shutting bridge down!")
-
-
-def sendToTelegramChat(destination, text, useMarkdown=False):
-	if telegramConfig["stripAllAtSignsFromBotText"]:
-		text = text.replace("@", "")
-	if telegramConfig["forceConvertUsernamesToAtUsernames"]:
-		temporary = text.split(" ")
-		for word in temporary:
-			for cachedUserId, cachedUserInfo in telegramCache["users"].items():
-				if cachedUserInfo[0] == word:
-					word = "@" + word
-					printLog("Compat DEBUG", "Forcibly converted a username to a mention")
-		text = " ".join(temporary)
-	text.encode("utf-8")
-
-	# wow, multiline!
-	text = text.replace("\x01NEWLINE\x01", "\n")
+		result = call()
+		observeMetric("bridge_telegram_api_seconds", monotonic() - callStart, 'method="' + method + '"')
+		return result
+	except RetryAfter as error:
+		with adminCacheLock:
+			adminRefreshBucket.block(error.retry_after, monotonic())
+		countMetric("bridge_telegram_api_errors_total", 'method="' + method + '",error="RetryAfter"')
+		printLog("Cache WARNING", "Telegram asked us to slow down fetching group info, backing off " + str(error.retry_after) + "s")
+	except Exception as error:
+		countMetric("bridge_telegram_api_errors_total", 'method="' + method + '",error="' + type(error).__name__ + '"')
+		printLog("Cache WARNING", "Call to " + method + " failed: " + str(error))
+	return None
+
+
+def adminCacheRefresher():
+	# background threads. fetch admin lists and member counts off the message path and tell IRC about whatever changed
+	while True:
+		priority, queuedAt, groupId = adminRefreshQueue.get()
+		with adminCacheLock:
+			if adminRefreshPending.get(groupId) != priority:
+				continue  # already done, or queued again at a higher priority
+		fetchedAdmins = fetchFromTelegram("getChatAdministrators", lambda: telegramBotInterface.get_chat_administrators(chat_id=int(groupId)))
+		memberCount = None
+		if fetchedAdmins is not None:
+			memberCount = fetchFromTelegram("getChatMemberCount", lambda: telegramBotInterface.get_chat_member_count(chat_id=int(groupId)))
+		with adminCacheLock:
+			adminRefreshPending.pop(groupId, None)
+			if fetchedAdmins is None:
+				if groupId in adminCache:
+					adminCache[groupId][0] = monotonic()  # keep the stale list, but don't hammer the API about it
+				else:
+					adminCache[groupId] = [monotonic(), None, None]  # remembered, so JOINs don't wait on it again until the TTL is up
+				admins = None
+			else:
+				admins = {}
+				for chatMember in fetchedAdmins:
+					if chatMember.user.username is not None:  # @-less admins can't be represented on IRC
+						admins[chatMember.user.id] = str(chatMember.user.username).lower()
+				if memberCount is None and groupId in adminCache:
+					memberCount = adminCache[groupId][2]
+				adminCache[groupId] = [monotonic(), admins, memberCount]
+		if admins is not None:
+			try:
+				applyAdminList(groupId, admins)
+			except Exception as error:
+				printLog("Cache ERROR", "Failed to apply admin list for TGG " + groupId + ": " + str(error))
+			with cacheLock:
+				knownMembers = len(telegramCache["groups"].get(int(groupId), ()))
+			printLog("Cache", "Refreshed TGG %s: %d admins, %d of %s members known", groupId, len(admins), knownMembers, memberCount)
+		ircLoop.call_soon_threadsafe(finishGroupWarmup, groupId)  # JOINs waiting on this group can have their NAMES now
+
+
+def applyAdminList(groupId, admins):
+	# diff a freshly fetched admin list against the cached group state as sets, update the cache for just the differences,
+	# and send the bot all resulting JOIN/MODE lines in one go
+	destination = "#" + groupId
+	joinedUsers = []
+	promotedUsers = []
+	demotedUsers = []
+	with cacheLock:  # held throughout, so the diff can't go stale halfway through applying it
+		loadCachedGroup(int(groupId))
+		cachedGroup = telegramCache["groups"].get(int(groupId), CachedGroup())
+		cachedAdmins = set(cachedUserId for cachedUserId, cachedUserIsAdmin in cachedGroup.items() if cachedUserIsAdmin is True)
+		fetchedAdmins = set(admins)
+		for adminUserId in fetchedAdmins:
+			loadCachedUser(adminUserId)
+		renamedAdmins = set(adminUserId for adminUserId in fetchedAdmins if adminUserId in telegramCache["users"] and telegramCache["users"][adminUserId].name != admins[adminUserId])
+		for adminUserId in [adminUserId for adminUserId in admins if adminUserId not in cachedAdmins or adminUserId in renamedAdmins]:  # new admins, in telegram's order
+			foundNewListedUserStatus, foundNewListedAdminStatus = saveUserToCache(adminUserId, admins[adminUserId], groupId, True, None)
+			if foundNewListedUserStatus:
+				joinedUsers.append((adminUserId, admins[adminUserId]))
+			if foundNewListedAdminStatus:
+				promotedUsers.append(admins[adminUserId])
+		for formerAdminUserId in [cachedUserId for cachedUserId in cachedGroup.members if cachedUserId in cachedAdmins and cachedUserId not in fetchedAdmins]:
+			formerAdminUserName = telegramCache["users"][formerAdminUserId].name
+			foundNewListedUserStatus, foundNewListedAdminStatus = saveUserToCache(formerAdminUserId, formerAdminUserName, groupId, False, None)
+			if foundNewListedAdminStatus is False:
+				demotedUsers.append(formerAdminUserName)
+	if joinedUsers or promotedUsers or demotedUsers:
+		sendToIrcChannel(destination, membershipChangeLines(destination, joinedUsers, promotedUsers, demotedUsers))
+
+
+def membershipChangeLines(destination, joinedUsers, promotedUsers, demotedUsers):
+	# JOINs for [ ( userId, userName ), ... ] new to the channel, then +o-v / -o+v for the promoted and demoted usernames,
+	# packed up to ircModesPerLine changes to a MODE line and under IRC's line length limit
+	changeLines = [":" + prefixUsernames() + userName + "!" + str(userId) + "@telegram.irc.bridge JOIN " + destination for userId, userName in joinedUsers]
+	modeChanges = []
+	for userName in promotedUsers:
+		modeChanges += [("+", "o", prefixUsernames() + userName), ("-", "v", prefixUsernames() + userName)]
+	for userName in demotedUsers:
+		modeChanges += [("-", "o", prefixUsernames() + userName), ("+", "v", prefixUsernames() + userName)]
+	lineStart = ":telegram.irc.bridge MODE " + destination + " "
+	modeBatch = []
+	batchLength = len(lineStart)
+	for modeChange in modeChanges:
+		if modeBatch and (len(modeBatch) == ircModesPerLine or batchLength + len(modeChange[2]) + 3 > ircLineLimit):  # sign, letter and a space
+			changeLines.append(packModeLine(lineStart, modeBatch))
+			modeBatch = []
+			batchLength = len(lineStart)
+		modeBatch.append(modeChange)
+		batchLength += len(modeChange[2]) + 3
+	if modeBatch:
+		changeLines.append(packModeLine(lineStart, modeBatch))
+	return changeLines
+
+
+def packModeLine(lineStart, modeChanges):
+	# [ ( "+", "o", nick ), ... ] -> "+oo-vv nick1 nick2 nick1 nick2", each sign written once
+	modeChanges = sorted(modeChanges, key=lambda modeChange: modeChange[:2])  # stable, so nicks keep their order within a mode
+	modeString = ""
+	currentSign = None
+	for sign, letter, nick in modeChanges:
+		if sign != currentSign:
+			modeString += sign
+			currentSign = sign
+		modeString += letter
+	return lineStart + modeString + " " + " ".join(modeChange[2] for modeChange in modeChanges)
+
+
+def sendToIrc(client, string):
+	# event loop only. one line to one client
+	client.queueOutput((string + "\r\n").encode("utf-8"))
+
+
+def sendLinesToIrc(client, lines):
+	# event loop only. several lines to one client, encoded and queued as one chunk
+	client.queueOutput(("\r\n".join(lines) + "\r\n").encode("utf-8"))
+
+
+def sendToIrcChannel(destination, lines):
+	# safe to call from any thread. TG->IRC lines for a "#chatid" channel, or a DM (destination is a username). they're
+	# encoded once here, and the event loop hands that same chunk to every client that joined the channel, or for DMs to
+	# every logged in client
+	data = ("\r\n".join(lines) + "\r\n").encode("utf-8")
+	if threading.get_ident() == ircLoopThreadId:
+		fanOutIrcOutput(destination, data, False)
+	else:
+		# backpressure. a stalled event loop eventually holds up whoever is producing lines for it, rather than eating all our memory
+		if not ircSendSlots.acquire(timeout=telegramConfig["ircSendBlockSeconds"]):
+			printLog("IRC WARNING", "IRC side isn't keeping up! Dropped a line.")
+			return False
+		ircLoop.call_soon_threadsafe(fanOutIrcOutput, destination, data, True)
+	return True
+
+
+def ircRecipients(destination):
+	# event loop only. who gets TG->IRC output for a "#chatid" channel or a DM
+	if destination.startswith("#"):
+		return tuple(ircChannelClients.get(destination, ()))
+	return tuple(ircRegisteredClients)
+
+
+def fanOutIrcOutput(destination, data, holdsSlot):
+	# event loop only. cost is one list append per subscribed client
+	for client in ircRecipients(destination):
+		client.queueOutput(data)
+	if holdsSlot:
+		ircSendSlots.release()
+
+
+def fanOutLatencyMark(destination, sentAt):
+	# event loop only. runs after the fanOutIrcOutput calls for a message's lines, which came through the same queue
+	for client in ircRecipients(destination):
+		client.observeOnWrite("bridge_telegram_to_irc_latency_seconds", sentAt)
+
+
+def sendChatLineToIrc(destination, line, sentAt):
+	# TG->IRC chat lines. with nobody there to see them (no client logged in for DMs, nobody in the channel for groups)
+	# they go into a per-destination ring buffer instead, replayed to whoever turns up first: DMs right after the welcome,
+	# channels on JOIN. until then newer lines queue up behind them
+	with ircReplayLock:
+		if destination in ircReplayBuffers or (destination not in ircChannelClients if destination.startswith("#") else not ircRegisteredClients):
+			replayBuffer = ircReplayBuffers.get(destination)
+			if replayBuffer is None:
+				replayBuffer = ircReplayBuffers[destination] = deque(maxlen=telegramConfig["ircReplayBufferLines"])
+			replayBuffer.append((sentAt, line))
+			return
+	sendToIrcChannel(destination, [line])
 
+
+def replayIrcBuffer(client, destination):
+	# event loop only. send whatever was buffered for destination while nobody was logged in, timestamped if the client can take that
+	with ircReplayLock:
+		replayBuffer = ircReplayBuffers.pop(destination, None)
+		if not replayBuffer:
+			return
+		if "server-time" in client.caps:
+			sendLinesToIrc(client, ["@time=" + ircServerTime(sentAt) + " " + line for sentAt, line in replayBuffer])
+		else:
+			sendLinesToIrc(client, [line for sentAt, line in replayBuffer])
+	printLog("IRC", "Replayed %d buffered lines to %s for %s", len(replayBuffer), destination, client.nick)
+
+
+def ircServerTime(timestamp):  # IRCv3 server-time tag value
+	return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def buildIrcWelcomeBurst():
+	# everything we send a client after USER, from 002 to the end of the MOTD. it only changes with the nick, so it's
+	# encoded once up front and split around the nick. renderIrcWelcomeBurst glues it back together.
+	nickPlaceholder = "\x00"
+	welcomeLines = [
+		":telegram.irc.bridge 002 " + nickPlaceholder + " :Your host is telegram.irc.bridge, running telegramircbridge-v" + bridgeVersion,  # more information
+		":telegram.irc.bridge 003 " + nickPlaceholder + " :This server was created in the beginning of time. It only just now accepts connections.",  # server creation date
+		":telegram.irc.bridge 004 " + nickPlaceholder + " Telegram telegramircbridge-v" + bridgeVersion + " Biwxs Yqaohvrnmtsi",  # server short-name, software version, usermodes, channelmodes, parametered channel modes. (channel modes here should not be parsed by clients apparently)
+	]
+
+	# capabilities, server information and other pertinent details
+	for capability in [
+		"AWAYLEN=200",  # not supported
+		"CASEMAPPING=rfc1459",  # also not supported
+		"CHANMODES=,,,imnrst",  # updated to match our actual capabilities as a server
+		"CHANNELLEN=32",  # not enforced
+		"CHANTYPES=#",
+		"CHARSET=utf-8",  # not enforced but required by clients
+		"KICKLEN=40",  # kicks are not supported
+		"MAXBANS=1",  # modes in general are not supported
+		"CHANLIMIT=#:",  # join as many groups as you like
+		"MAXPARA=1",
+		"MAXTARGETS=1",
+		"MODES=" + str(ircModesPerLine),  # how many of our own mode changes we pack into a line
+		"NAMESX",
+		"NETWORK=Telegram",
+		"NICKLEN=32",  # not enforced
+		"PREFIX=(Yqaohv)!~&@%+",  # planned expanded support
+		"UHNAMES"  # implemented
+	]:
+		welcomeLines.append(":telegram.irc.bridge 005 " + nickPlaceholder + " " + capability + " :are supported by this server")
+
+	# and, since this IS technically IRC, let's send a big-ass ASCII art image, as is tradition.
+	welcomeLines.append(":telegram.irc.bridge 375 " + nickPlaceholder + " :telegram.irc.bridge message of the day")  # motd start
+	for motdLine in [
+		"- TTTTTTTTTTTTTTTTTTTTTTTT0kxdoooooooddkTTTTTTTTTTTTTTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTTTTTTTTko:'..              .';lx0TTTTTTTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTTTTkl,.                         .'cxTTTTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTTc'                                 .:kTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTx;                                       'dTTTTTTTTTTT ",
+		"- TTTTTTTTk;                                           'xTTTTTTTTT ",
+		"- TTTTTTTl.                                              :0TTTTTTT ",
+		"- TTTTT0;                                                 'kTTTTTT ",
+		"- TTTTT'                                                   .xTTTTT ",
+		"- TTT0'                                    .,coo;           .xTTTT ",
+		"- TTT:                                .,cdkTTTTTd.           '0TTT ",
+		"- TTd.                          .;cldTTTTTTTTTTT:             cTTT ",
+		"- TT;                     .';ldTTTTTTTTkxkTTTTTT'             .TTT ",
+		"- TT.                .':ox0TTTTTTTTTxccd0TTTTTTl               lTT ",
+		"- To            .':okTTTTTTTTTT0d;'';dTTTTTTTTT,               cTT ",
+		"- Tl           ,TTTTTTTTTTTTTo;..,lxTTTTTTTTTTd.               :TT ",
+		"- Tx.          .';ldk0TTTTl,. .;kTTTTTTTTTTTTT;                cTT ",
+		"- T0,                ..'.   .:TTTTTTTTTTTTTTTk.               .dTT ",
+		"- TTc                      .kTTTTTTTTTTTTTTTTc                ,TTT ",
+		"- TTT.                     ;TTTTTTTTTTTTTTTT0'               .dTTT ",
+		"- TTTo.                    :TTTx::okTTTTTTTTl                :TTTT ",
+		"- TTTTl                    :0d,     'lTTTTTT;               ;TTTTT ",
+		"- TTTTTl                   ..         .;d0Tl.              ;TTTTTT ",
+		"- TTTTTTd.                               ..               cTTTTTTT ",
+		"- TTTTTTTT;                                             'xTTTTTTTT ",
+		"- TTTTTTTTTx,                                         .oTTTTTTTTTT ",
+		"- TTTTTTTTTTTk;.                                    ,oTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTT0o,.                              'ckTTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTTTTT0dc,.                     .':oTTTTTTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTTTTTTTTTTkdo:,''........',;ldk0TTTTTTTTTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT ",
+		"- TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT ",
+		"- Telegram IRC Bridge v" + bridgeVersion,
+		"- Rules: Do not spam. Maximum 20 API calls (messages) per minute.",  # as per telegram API documentation.
+		"- Other rules up to interpretation by Telegram itself."
+	]:
+		welcomeLines.append(":telegram.irc.bridge 375 " + nickPlaceholder + " :" + motdLine)
+	welcomeLines.append(":telegram.irc.bridge 376 " + nickPlaceholder + " :End of message of the day.")  # end of MOTD
+	return ("\r\n".join(welcomeLines) + "\r\n").encode("utf-8").split(nickPlaceholder.encode("utf-8"))
+
+
+def renderIrcWelcomeBurst(nick):
+	return nick.encode("utf-8").join(ircWelcomeBurst)
+
+
+class TokenBucket:
+	# plain token bucket. refills at rate tokens per second, holds at most capacity of them
+	__slots__ = ("rate", "capacity", "tokens", "updated", "blockedUntil")
+
+	def __init__(self, rate, capacity):
+		self.rate = float(rate)
+		self.capacity = float(capacity)
+		self.tokens = float(capacity)
+		self.updated = monotonic()
+		self.blockedUntil = 0.0  # set when telegram tells us to back off (RetryAfter)
+
+	def delay(self, now):
+		# seconds until a token can be taken. 0 means right now
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		tokenDelay = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+		return max(tokenDelay, self.blockedUntil - now)
+
+	def take(self, now):
+		self.delay(now)
+		self.tokens -= 1
+
+	def block(self, seconds, now):
+		self.blockedUntil = max(self.blockedUntil, now + seconds)
+
+
+def sendToTelegramChat(destination, text, useMarkdown=False, priority=None, codeLabel=None):
+	# never blocks on the network. the message is queued for the telegramSender workers, which pace it under telegram's flood limits.
+	# with codeLabel, text is the client's own and goes out as a MarkdownV2 code span after the label, escaped to match
 	if text is None:
 		return False
+	if priority is None:
+		priority = telegramPriorityBulk
+	text = rewriteOutboundText(str(destination), str(text), codeLabel is not None)
+	if codeLabel is not None:
+		text = "`" + codeLabel + text + "`"
+		useMarkdown = True
+	return queueTelegramMessage(str(destination), text, useMarkdown, priority)
+
+
+def rewriteOutboundText(destination, text, escapeForCode=False):
+	# everything done to text on its way to telegram, in one regex pass: \x01NEWLINE\x01 markers, @-stripping, usernames
+	# turned into mentions (only for members of the destination group), and escaping for a MarkdownV2 code span
+	stripAtSigns = telegramConfig["stripAllAtSignsFromBotText"]
+	convertMentions = telegramConfig["forceConvertUsernamesToAtUsernames"]
+	if not convertMentions and not escapeForCode:  # plain substitutions. str.replace beats calling back into python per match
+		if stripAtSigns:
+			text = text.replace("@", "")
+		return text.replace("\x01NEWLINE\x01", "\n")
+	pattern = outboundTextPatterns.get((stripAtSigns, convertMentions, escapeForCode))
+	if pattern is None:
+		patternParts = ["\x01NEWLINE\x01"]  # wow, multiline!
+		if stripAtSigns:
+			patternParts.append("@")
+		if convertMentions:
+			# standalone words only: not part of a URL, path, email address or hyphenated word. an @ in front is fine
+			# (it's stripped, or the word already is a mention) unless that @ is itself inside an email address or URL
+			patternParts.append("(?<![\\w/.:-])(?<![\\w/.:-]@)\\w+(?![\\w@/-]|\\.\\w)")
+		if escapeForCode:
+			patternParts.append("[`\\\\]")
+		pattern = outboundTextPatterns[(stripAtSigns, convertMentions, escapeForCode)] = re.compile("|".join(patternParts))
+
+	if not convertMentions:
+		return pattern.sub(lambda match: outboundTextReplacements.get(match.group(), "\\" + match.group()), text)
+
+	def rewriteToken(match):
+		token = match.group()
+		if token in outboundTextReplacements or not (token[0].isalnum() or token[0] == "_"):
+			return outboundTextReplacements.get(token, "\\" + token)
+		if match.start() > 0 and text[match.start() - 1] == "@" and not stripAtSigns:
+			return token  # already a mention
+		mentionedUserId = usernameIndex.get(token.lower())
+		if mentionedUserId is None or (groupMembers is not None and mentionedUserId not in groupMembers):
+			return token
+		return "@" + token
+
+	with cacheLock:
+		groupMembers = None  # DMs can mention anybody we know
+		if int(destination) < 0:
+			loadCachedGroup(int(destination))
+			groupMembers = telegramCache["groups"].get(int(destination), CachedGroup())
+		return pattern.sub(rewriteToken, text)
+
+
+def queueTelegramMessage(destination, text, useMarkdown, priority):
+	global telegramOutboxDepth
+	with telegramOutboxCondition:
+		if telegramOutboxDepth >= telegramConfig["telegramOutboxLimit"]:
+			if telegramConfig["telegramOutboxOverflowPolicy"] != "dropOldest" or not dropOldestTelegramMessage():
+				telegramOutboxStats["dropped"] += 1
+				printLog("Compat WARNING", "Telegram outbox full, dropped a message to " + destination)
+				return False
+		chatOutbox = telegramOutbox.get(destination)
+		if chatOutbox is None:
+			# "sender" is the telegramSenders entry this chat goes out through. it only changes on failover, so order within a chat holds
+			chatOutbox = {"queues": [deque(), deque()], "bucket": newChatBucket(destination), "sender": assignTelegramSender(destination), "avoidSenders": {}, "inFlight": False, "sent": 0, "lastWaitSeconds": 0.0, "maxWaitSeconds": 0.0}
+			telegramOutbox[destination] = chatOutbox
+		now = monotonic()
+		chatQueue = chatOutbox["queues"][priority]
+		if priority == telegramPriorityBulk and not useMarkdown:
+			# IRC bots send lists a line at a time. fold lines that arrive close together into the message still waiting to go out
+			if chatQueue and not chatQueue[-1][2] and now - chatQueue[-1][4] <= telegramConfig["telegramCoalesceWindowSeconds"] and len(chatQueue[-1][1]) + 1 + len(text) <= telegramMessageLengthLimit:
+				chatQueue[-1][1] = chatQueue[-1][1] + "\n" + text
+				chatQueue[-1][4] = now
+				telegramOutboxStats["coalesced"] += 1
+				return True
+			# and give the first line of a burst a moment for the rest of it to show up
+			chatQueue.append([now, text, useMarkdown, now + telegramConfig["telegramCoalesceWindowSeconds"], now])
+		else:
+			chatQueue.append([now, text, useMarkdown, now, now])  # [ enqueuedAt, text, useMarkdown, notBefore, lastLineAt ]
+		telegramOutboxDepth += 1
+		telegramOutboxPending.add(destination)
+		telegramOutboxCondition.notify()
+	return True
+
+
+def newTelegramRequest():
+	# HTTP connection pool for one of our Bot objects. python-telegram-bot's default keeps a single connection, which
+	# parallel senders would keep throwing away and reconnecting. size it for every sender and group refresher thread, plus
+	# one spare for the odd call from elsewhere (catch-up, webhook registration)
+	return Request(con_pool_size=max(1, telegramConfig["telegramSendWorkers"]) + max(1, telegramConfig["groupRefreshWorkers"]) + 1, connect_timeout=5.0, read_timeout=10.0)
+
+
+def newChatBucket(destination):
+	# the flood limit telegram applies to one bot in one chat
+	if int(destination) < 0:  # groups
+		return TokenBucket(telegramConfig["telegramGroupMessagesPerMinute"] / 60.0, telegramConfig["telegramGroupMessageBurst"])
+	else:  # DMs
+		return TokenBucket(telegramConfig["telegramPrivateMessagesPerSecond"], 1)
+
+
+def assignTelegramSender(destination):
+	# groups are spread over the sender pool by a stable hash of their id. DMs always use the main bot, it's the one users /start
+	if len(telegramSenders) == 1 or int(destination) > 0:
+		return 0
+	return zlib.crc32(destination.encode("utf-8")) % len(telegramSenders)
+
+
+def failoverTelegramChat(destination, failedSender, avoidFor):
+	# telegramOutboxCondition held. move a chat off a sender that can't post there right now. False if nobody else can take it
+	chatOutbox = telegramOutbox[destination]
+	now = monotonic()
+	chatOutbox["avoidSenders"][failedSender] = now + avoidFor
+	if int(destination) > 0:
+		return False
+	for offset in range(1, len(telegramSenders)):
+		candidate = (failedSender + offset) % len(telegramSenders)
+		if chatOutbox["avoidSenders"].get(candidate, 0) <= now:
+			chatOutbox["sender"] = candidate
+			chatOutbox["bucket"] = newChatBucket(destination)  # each bot has its own allowance in the chat
+			countMetric("bridge_telegram_sender_failovers_total")
+			printLog("Compat WARNING", "Moved " + destination + " from " + telegramSenders[failedSender]["name"] + " to " + telegramSenders[candidate]["name"])
+			return True
+	return False
+
+
+def dropOldestTelegramMessage():
+	# telegramOutboxCondition held. makes room by dropping the oldest queued bulk message. control messages are never dropped
+	global telegramOutboxDepth
+	oldestChat = None
+	for pendingChat in telegramOutboxPending:
+		bulkQueue = telegramOutbox[pendingChat]["queues"][telegramPriorityBulk]
+		if bulkQueue and (oldestChat is None or bulkQueue[0][0] < telegramOutbox[oldestChat]["queues"][telegramPriorityBulk][0][0]):
+			oldestChat = pendingChat
+	if oldestChat is None:
+		return False
+	telegramOutbox[oldestChat]["queues"][telegramPriorityBulk].popleft()
+	telegramOutboxDepth -= 1
+	if not any(telegramOutbox[oldestChat]["queues"]):
+		telegramOutboxPending.discard(oldestChat)
+	telegramOutboxStats["dropped"] += 1
+	printLog("Compat WARNING", "Telegram outbox full, dropped the oldest message queued for " + oldestChat)
+	return True
+
+
+def takeNextTelegramMessage(now):
+	# telegramOutboxCondition held. picks the next message that's allowed out right now, control traffic and older messages first.
+	# returns ( chatId, priority, item ) and the time to wait before trying again if nothing can go yet
+	global telegramOutboxDepth
+	waitFor = None
+	chosenChat = None
+	chosenKey = None
+	for pendingChat in telegramOutboxPending:
+		chatOutbox = telegramOutbox[pendingChat]
+		if chatOutbox["inFlight"]:  # one message per chat on the wire at a time keeps each chat in order
+			continue
+		chatDelay = max(chatOutbox["bucket"].delay(now), telegramSenders[chatOutbox["sender"]]["bucket"].delay(now))  # the chat's limit and its bot's overall limit
+		if chatDelay > 0:
+			waitFor = chatDelay if waitFor is None else min(waitFor, chatDelay)
+			continue
+		for priority, chatQueue in enumerate(chatOutbox["queues"]):
+			if chatQueue:
+				holdFor = chatQueue[0][3] - now
+				if holdFor > 0:  # still gathering a burst
+					waitFor = holdFor if waitFor is None else min(waitFor, holdFor)
+					continue
+				candidateKey = (priority, chatQueue[0][0])
+				if chosenKey is None or candidateKey < chosenKey:
+					chosenChat, chosenKey = pendingChat, candidateKey
+				break
+	if chosenChat is None:
+		return None, waitFor
+	chatOutbox = telegramOutbox[chosenChat]
+	item = chatOutbox["queues"][chosenKey[0]].popleft()
+	telegramOutboxDepth -= 1
+	if not any(chatOutbox["queues"]):
+		telegramOutboxPending.discard(chosenChat)
+	chatOutbox["bucket"].take(now)
+	telegramSenders[chatOutbox["sender"]]["bucket"].take(now)
+	chatOutbox["inFlight"] = True
+	waitedSeconds = now - item[0]
+	chatOutbox["sent"] += 1
+	chatOutbox["lastWaitSeconds"] = waitedSeconds
+	chatOutbox["maxWaitSeconds"] = max(chatOutbox["maxWaitSeconds"], waitedSeconds)
+	observeMetric("bridge_telegram_flood_wait_seconds", waitedSeconds)
+	if waitedSeconds > 5:
+		printLog("Compat WARNING", "Message to " + chosenChat + " waited " + str(round(waitedSeconds, 1)) + "s for flood control (" + str(len(chatOutbox["queues"][0]) + len(chatOutbox["queues"][1])) + " still queued)")
+	return (chosenChat, chosenKey[0], item, chatOutbox["sender"]), None
+
+
+def telegramSender():
+	# background worker, telegramSendWorkers of them. the only things that actually send messages to telegram.
+	# different chats go out in parallel, each chat strictly one message after the other
+	global telegramSendsInFlight
+	while True:
+		with telegramOutboxCondition:
+			while True:
+				nextMessage, waitFor = takeNextTelegramMessage(monotonic())
+				if nextMessage is not None:
+					break
+				telegramOutboxCondition.wait(waitFor)
+			telegramSendsInFlight += 1
+		try:
+			deliverTelegramMessage(*nextMessage)
+		finally:
+			with telegramOutboxCondition:
+				telegramSendsInFlight -= 1
+				telegramOutbox[nextMessage[0]]["inFlight"] = False
+				if nextMessage[0] in telegramOutboxPending:
+					telegramOutboxCondition.notify()  # that chat's next message can go now
+
+
+def requeueTelegramMessage(destination, priority, item):
+	# telegramOutboxCondition held. put a message that didn't go out back at the front of its queue
+	global telegramOutboxDepth
+	telegramOutbox[destination]["queues"][priority].appendleft(item)
+	telegramOutboxDepth += 1
+	telegramOutboxPending.add(destination)
+	telegramOutboxCondition.notify()
+
+
+def deliverTelegramMessage(destination, priority, item, senderIndex):
+	enqueuedAt, text, useMarkdown = item[:3]
+	senderBot = telegramSenders[senderIndex]["bot"]
+	callStart = monotonic()
 	try:
 		if useMarkdown:
-			telegramBotInterface.send_message(chat_id=int(destination), text=str(text), parse_mode=ParseMode.MARKDOWN_V2)
+			senderBot.send_message(chat_id=int(destination), text=text, parse_mode=ParseMode.MARKDOWN_V2)
 		else:
-			telegramBotInterface.send_message(chat_id=int(destination), text=str(text))
-	except telegram.error.Unauthorized:
-		printLog("Compat WARNING", "Bridge unauthorized to send messages to conversation ID " + str(destination))
+			senderBot.send_message(chat_id=int(destination), text=text)
+		callEnd = monotonic()
+		observeMetric("bridge_telegram_api_seconds", callEnd - callStart, 'method="sendMessage"')
+		observeMetric("bridge_irc_to_telegram_latency_seconds", callEnd - enqueuedAt)
+	except RetryAfter as error:
+		countMetric("bridge_telegram_api_errors_total", 'method="sendMessage",error="RetryAfter"')
+		# flood control kicked in anyway. put it back at the front and hand the chat to another sender, or leave it alone for as long as telegram asks
+		printLog("Compat WARNING", "Telegram asked " + telegramSenders[senderIndex]["name"] + " to back off from " + destination + " for " + str(error.retry_after) + "s")
+		with telegramOutboxCondition:
+			if not failoverTelegramChat(destination, senderIndex, error.retry_after):
+				telegramOutbox[destination]["bucket"].block(error.retry_after, monotonic())
+			requeueTelegramMessage(destination, priority, item)
+	except Unauthorized:
+		countMetric("bridge_telegram_api_errors_total", 'method="sendMessage",error="Unauthorized"')
+		printLog("Compat WARNING", telegramSenders[senderIndex]["name"] + " unauthorized to send messages to conversation ID " + destination)
+		with telegramOutboxCondition:
+			if failoverTelegramChat(destination, senderIndex, telegramSenderExcludeSeconds):  # not in that group? another bot may be
+				requeueTelegramMessage(destination, priority, item)
+				return
 		if int(destination) > 0:
 			# destination was a user. disable PMs to them
-			saveUserToCache(str(destination), None, None, None, False)
-			printLog("Compat WARNING", "Automatically disabled DMs for TUser " + str(destination))
-	except:
-		printLog("Compat ERROR", "An error occured when attempting to send a message to Telegram. Ignoring! [fix this, arghlex]")
+			saveUserToCache(destination, None, None, None, False)
+			printLog("Compat WARNING", "Automatically disabled DMs for TUser " + destination)
+	except Exception as error:
+		countMetric("bridge_telegram_api_errors_total", 'method="sendMessage",error="' + type(error).__name__ + '"')
+		printLog("Compat ERROR", "An error occured when attempting to send a message to Telegram. Ignoring! (" + str(error) + ")")
+
+
+def getTelegramOutboxStats():
+	# queue depth and flood-control wait times, per chat
+	with telegramOutboxCondition:
+		chatStats = {}
+		for chatId, chatOutbox in telegramOutbox.items():
+			chatStats[chatId] = {"queued": len(chatOutbox["queues"][0]) + len(chatOutbox["queues"][1]), "sender": telegramSenders[chatOutbox["sender"]]["name"], "sent": chatOutbox["sent"], "lastWaitSeconds": chatOutbox["lastWaitSeconds"], "maxWaitSeconds": chatOutbox["maxWaitSeconds"], "inFlight": chatOutbox["inFlight"]}
+		return {"queued": telegramOutboxDepth, "dropped": telegramOutboxStats["dropped"], "coalesced": telegramOutboxStats["coalesced"], "chats": chatStats}
+
+
+class MetricsHistogram:  # cumulative-bucket histogram, prometheus style
+	__slots__ = ("counts", "total", "count")
+
+	def __init__(self):
+		self.counts = [0] * (len(metricsHistogramBuckets) + 1)  # last slot is +Inf
+		self.total = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(metricsHistogramBuckets, value)] += 1
+		self.total += value
+		self.count += 1
+
+
+def countMetric(name, labels="", amount=1):
+	# labels are pre-rendered prometheus label text, like 'direction="irc_to_telegram"'
+	with metricsLock:
+		metricsCounters[(name, labels)] = metricsCounters.get((name, labels), 0) + amount
+
+
+def observeMetric(name, value, labels=""):
+	with metricsLock:
+		histogram = metricsHistograms.get((name, labels))
+		if histogram is None:
+			histogram = metricsHistograms[(name, labels)] = MetricsHistogram()
+		histogram.observe(value)
+
+
+def observeSince(name, startedAt):  # wall-clock latency from a unix timestamp, e.g. telegram's message.date (whole seconds)
+	observeMetric(name, max(0.0, time() - startedAt))
+
+
+def renderMetrics():
+	# everything we track, in prometheus' text exposition format
+	outboxStats = getTelegramOutboxStats()
+	with cacheLock:
+		cachedUsers = len(telegramCache["users"])
+		cachedGroups = len(telegramCache["groups"])
+	gauges = [
+		("bridge_uptime_seconds", monotonic() - bridgeStartedAt),
+		("bridge_first_message_seconds", bridgeFirstMessageSeconds if bridgeFirstMessageSeconds is not None else "NaN"),
+		("bridge_cache_users", cachedUsers),
+		("bridge_cache_groups", cachedGroups),
+		("bridge_cache_dirty_changes", cacheDirtyCount),
+		("bridge_cache_flushes_total", cacheFlushStats["flushes"]),
+		("bridge_telegram_outbox_queued", outboxStats["queued"]),
+		("bridge_telegram_sends_in_flight", telegramSendsInFlight),
+		("bridge_telegram_updates_queued", inboundUpdatesQueued),
+		("bridge_telegram_updates_in_flight", inboundUpdatesInFlight),
+		("bridge_telegram_outbox_dropped_total", outboxStats["dropped"]),
+		("bridge_telegram_outbox_coalesced_total", outboxStats["coalesced"]),
+		("bridge_irc_send_buffer_lines", sum(len(client.sendBuffer) for client in list(ircClients))),
+		("bridge_irc_clients", len(ircRegisteredClients)),
+		("bridge_irc_channel_subscriptions", sum(len(channelClients) for channelClients in list(ircChannelClients.values()))),
+		("bridge_admin_refresh_queued", len(adminRefreshPending)),
+		("bridge_log_queued", logQueue.qsize())
+	]
+	lines = []
+	for name, value in gauges:
+		lines.append(name + " " + str(value))
+	# per group with something queued or being sent: its queue depth, and how long its last and longest-waiting messages
+	# sat in flood control. idle chats drop out, and DMs are never listed, so user ids don't end up as label values
+	busyGroups = sorted((chatId, chatStats) for chatId, chatStats in outboxStats["chats"].items() if int(chatId) < 0 and (chatStats["queued"] or chatStats["inFlight"]))
+	for name, statKey in [("bridge_telegram_chat_outbox_queued", "queued"), ("bridge_telegram_chat_flood_wait_last_seconds", "lastWaitSeconds"), ("bridge_telegram_chat_flood_wait_max_seconds", "maxWaitSeconds")]:
+		lines.append("# TYPE " + name + " gauge")
+		for chatId, chatStats in busyGroups:
+			lines.append(name + '{chat="' + chatId + '"} ' + str(chatStats[statKey]))
+	typedNames = set()
+	with metricsLock:
+		for (name, labels), value in sorted(metricsCounters.items()):
+			if name not in typedNames:
+				typedNames.add(name)
+				lines.append("# TYPE " + name + " counter")
+			lines.append(name + ("{" + labels + "}" if labels else "") + " " + str(value))
+		for (name, labels), histogram in sorted(metricsHistograms.items()):
+			if name not in typedNames:
+				typedNames.add(name)
+				lines.append("# TYPE " + name + " histogram")
+			labelPrefix = labels + "," if labels else ""
+			cumulative = 0
+			for bucketIndex, bucketCount in enumerate(histogram.counts):
+				cumulative += bucketCount
+				upperBound = str(metricsHistogramBuckets[bucketIndex]) if bucketIndex < len(metricsHistogramBuckets) else "+Inf"
+				lines.append(name + "_bucket{" + labelPrefix + 'le="' + upperBound + '"} ' + str(cumulative))
+			lines.append(name + "_sum" + ("{" + labels + "}" if labels else "") + " " + str(histogram.total))
+			lines.append(name + "_count" + ("{" + labels + "}" if labels else "") + " " + str(histogram.count))
+	return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):  # serves renderMetrics() to prometheus
+	def do_GET(self):
+		if self.path != "/metrics":
+			self.send_error(404)
+			return
+		body = ("\n".join(renderMetrics()) + "\n").encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):  # scrapes every few seconds would drown the log
+		pass
+
+
+def startMetricsServer():
+	if not telegramSecretConfig["metricsEnabled"]:
+		return
+	metricsServer = ThreadingHTTPServer((telegramSecretConfig["metricsHost"], telegramSecretConfig["metricsPort"]), MetricsHandler)
+	threading.Thread(target=metricsServer.serve_forever, name="metricsListener", daemon=True).start()
+	printLog("System", "Serving metrics on http://%s:%d/metrics", telegramSecretConfig["metricsHost"], telegramSecretConfig["metricsPort"])
 
 
 def prefixUsernames():  # probably a better way to handle this but whatever
@@ -290,26 +1242,317 @@ def loadCache(file="./usercache.json"):
 
 
 def saveCache(contents, file="./usercache.json"):
-	# save the telegram cache to disk
+	# save the telegram cache to disk. accepts the cache itself or an already-serialized copy of it
 	if contents is None or contents == {}:  # don't wipe our cache file whatsoever
 		printLog("Cache", "WARNING! Something just tried to wipe the cache!")
 		return None
-	with open(file, "w") as filehandle:
-		json.dump(contents, filehandle, sort_keys=True, indent=4)
-		printLog("Cache", "Saved cache.")
+	if not isinstance(contents, str):
+		contents = json.dumps(contents, separators=(",", ":"))
+	# write next to the real file and rename over it, so a crash mid-write can't leave us with half a cache
+	temporaryFile = file + ".tmp"
+	with open(temporaryFile, "w") as filehandle:
+		filehandle.write(contents)
+		filehandle.flush()
+		os.fsync(filehandle.fileno())
+	os.replace(temporaryFile, file)
+
+
+class CachedUser:  # one per known telegram user. usernames are interned, the same few strings turn up everywhere. treated as immutable
+	__slots__ = ("name", "dmAllowed")
+
+	def __init__(self, name=None, dmAllowed=None):
+		self.name = None if name is None else sys.intern(name)
+		self.dmAllowed = dmAllowed
+
+
+memberStateUnknown = 0  # admin states as stored in CachedGroup.states
+memberStateRegular = 1
+memberStateAdmin = 2
+memberStateCodes = {None: memberStateUnknown, False: memberStateRegular, True: memberStateAdmin}
+memberStateValues = (None, False, True)
+
+
+class CachedGroup:
+	# a group's members as a sorted array of 64-bit user ids, with a parallel byte array of their admin states.
+	# about 9 bytes a membership, where a dict of string ids costs well over a hundred. tokens holds the group's
+	# ready-made NAMES/WHO tokens once somebody has asked for them, and is dropped whenever membership changes
+	__slots__ = ("members", "states", "tokens")
+
+	def __init__(self, memberItems=()):
+		memberItems = sorted(memberItems)  # [ ( userId, isAdmin ), ... ]
+		self.members = array.array("q", [memberUserId for memberUserId, memberAdmin in memberItems])
+		self.states = bytearray(memberStateCodes[memberAdmin] for memberUserId, memberAdmin in memberItems)
+		self.tokens = None  # [ ( userId, "@name" or "+name" ), ... ], see listMemberTokens
+
+	def __len__(self):
+		return len(self.members)
+
+	def __contains__(self, userId):
+		return self.find(userId) >= 0
+
+	def find(self, userId):
+		position = bisect_left(self.members, userId)
+		if position < len(self.members) and self.members[position] == userId:
+			return position
+		return -1
+
+	def add(self, userId):  # True if they weren't a member yet
+		position = bisect_left(self.members, userId)
+		if position < len(self.members) and self.members[position] == userId:
+			return False
+		self.members.insert(position, userId)
+		self.states.insert(position, memberStateUnknown)
+		self.tokens = None
+		return True
+
+	def isAdmin(self, userId):  # True, False, or None for not known yet
+		return memberStateValues[self.states[self.find(userId)]]
+
+	def setAdmin(self, userId, isAdmin):
+		self.states[self.find(userId)] = memberStateCodes[isAdmin]
+		self.tokens = None
+
+	def items(self):
+		return zip(self.members, [memberStateValues[memberState] for memberState in self.states])
+
+	def copy(self):  # two buffer copies, no per-member work
+		groupCopy = CachedGroup()
+		groupCopy.members = array.array("q", self.members)
+		groupCopy.states = bytearray(self.states)
+		return groupCopy
+
+
+def compactCache(cacheJson):
+	# revision 2 cache file contents -> what's kept in memory: integer ids, CachedUser and CachedGroup
+	compactedCache = {
+		"users": dict((int(userId), CachedUser(userInfo[0], userInfo[1])) for userId, userInfo in cacheJson["users"].items()),
+		"groups": dict((int(groupId), CachedGroup((int(userId), isAdmin) for userId, isAdmin in groupMembers.items())) for groupId, groupMembers in cacheJson["groups"].items())
+	}
+	if "lastUpdateId" in cacheJson:
+		compactedCache["lastUpdateId"] = cacheJson["lastUpdateId"]
+	return compactedCache
+
+
+def expandCache(cache):
+	# ... and back again, for writing out
+	cacheJson = {
+		"users": dict((str(userId), [cachedUser.name, cachedUser.dmAllowed]) for userId, cachedUser in cache["users"].items()),
+		"groups": dict((str(groupId), dict((str(userId), isAdmin) for userId, isAdmin in cachedGroup.items())) for groupId, cachedGroup in cache["groups"].items())
+	}
+	if "lastUpdateId" in cache:
+		cacheJson["lastUpdateId"] = cache["lastUpdateId"]
+	return cacheJson
+
+
+class JsonCacheStore:  # the revision 2 usercache.json. all of it lives in memory and all of it is rewritten on every flush
+	lazy = False
+
+	def __init__(self, file="./usercache.json"):
+		self.file = file
+
+	def load(self):
+		return compactCache(loadCache(self.file))
+
+	def snapshot(self, cache, dirtyUsers, dirtyMemberships):  # cacheLock held. copies references and member buffers, nothing more
+		cacheSnapshot = {"users": dict(cache["users"]), "groups": dict((groupId, cachedGroup.copy()) for groupId, cachedGroup in cache["groups"].items())}
+		if "lastUpdateId" in cache:
+			cacheSnapshot["lastUpdateId"] = cache["lastUpdateId"]
+		return cacheSnapshot
+
+	def serialize(self, cacheSnapshot):  # without the lock. this is the expensive part
+		return json.dumps(expandCache(cacheSnapshot), separators=(",", ":"))
+
+	def write(self, serialized):
+		saveCache(serialized, self.file)
+
+	def listGroupIds(self):
+		with cacheLock:
+			return list(telegramCache["groups"])
+
+
+class SqliteCacheStore:  # one row per user and per membership. only the hot set is kept in memory, only changed rows are written
+	lazy = True
+	schema = """
+		CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, username TEXT, dm_allowed INTEGER);
+		CREATE INDEX IF NOT EXISTS users_username ON users (username);
+		CREATE TABLE IF NOT EXISTS memberships (group_id TEXT NOT NULL, user_id TEXT NOT NULL, is_admin INTEGER, PRIMARY KEY (group_id, user_id)) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS memberships_user ON memberships (user_id);
+		CREATE TABLE IF NOT EXISTS bridge_state (key TEXT PRIMARY KEY, value);
+	"""  # the memberships primary key doubles as the group id index
+
+	def __init__(self, file, legacyFile="./usercache.json"):
+		freshDatabase = not os.path.exists(file)
+		# lookups happen under cacheLock, writes on the persister thread. separate connections so WAL lets them overlap
+		self.readConnection = sqlite3.connect(file, check_same_thread=False)
+		self.writeConnection = sqlite3.connect(file, check_same_thread=False)
+		self.writeConnection.execute("PRAGMA journal_mode=WAL")
+		for connection in (self.readConnection, self.writeConnection):
+			connection.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent with this, a power cut only loses the last flush
+		self.writeConnection.executescript(self.schema)
+		if freshDatabase and os.path.exists(legacyFile):
+			self.migrate(legacyFile)
+
+	def migrate(self, legacyFile):
+		# one-shot import of a revision 2 usercache.json into a brand new database. the JSON file is left alone
+		legacyCache = loadCache(legacyFile)
+		userRows = [(userId, userInfo[0], userInfo[1]) for userId, userInfo in legacyCache["users"].items()]
+		membershipRows = [(groupId, userId, isAdmin) for groupId, groupMembers in legacyCache["groups"].items() for userId, isAdmin in groupMembers.items()]
+		self.write((userRows, membershipRows, legacyCache.get("lastUpdateId")))
+		printLog("Cache", "Migrated %d users and %d group memberships from %s", len(userRows), len(membershipRows), legacyFile)
+
+	def load(self):
+		loadedCache = {"users": {}, "groups": {}}  # the hot set starts out empty. rows are pulled in as they're needed
+		row = self.readConnection.execute("SELECT value FROM bridge_state WHERE key = 'lastUpdateId'").fetchone()
+		if row is not None:
+			loadedCache["lastUpdateId"] = row[0]
+		return loadedCache
+
+	def loadUser(self, userId):
+		row = self.readConnection.execute("SELECT username, dm_allowed FROM users WHERE user_id = ?", (str(userId),)).fetchone()
+		return None if row is None else CachedUser(row[0], storedBoolean(row[1]))
+
+	def loadUserByName(self, userName):
+		row = self.readConnection.execute("SELECT user_id, username, dm_allowed FROM users WHERE username = ? LIMIT 1", (userName,)).fetchone()
+		return None if row is None else (int(row[0]), CachedUser(row[1], storedBoolean(row[2])))
+
+	def listGroupIds(self):
+		return [int(row[0]) for row in self.readConnection.execute("SELECT DISTINCT group_id FROM memberships")]
+
+	def loadGroup(self, groupId):
+		members = {}
+		users = {}
+		for userId, isAdmin, userName, dmAllowed in self.readConnection.execute("SELECT memberships.user_id, is_admin, username, dm_allowed FROM memberships LEFT JOIN users ON users.user_id = memberships.user_id WHERE group_id = ?", (str(groupId),)):
+			members[int(userId)] = storedBoolean(isAdmin)
+			users[int(userId)] = CachedUser(userName, storedBoolean(dmAllowed))
+		return members, users
+
+	def snapshot(self, cache, dirtyUsers, dirtyMemberships):  # cacheLock held. only the changed rows, so already cheap
+		userRows = [(str(userId), cache["users"][userId].name, cache["users"][userId].dmAllowed) for userId in dirtyUsers]
+		membershipRows = [(str(groupId), str(userId), cache["groups"][groupId].isAdmin(userId)) for groupId, userId in dirtyMemberships]
+		return userRows, membershipRows, cache.get("lastUpdateId")
+
+	def serialize(self, rows):
+		return rows
+
+	def write(self, rows):
+		userRows, membershipRows = rows[:2]
+		with self.writeConnection:  # one transaction per flush
+			if len(rows) > 2 and rows[2] is not None:
+				self.writeConnection.execute("INSERT INTO bridge_state (key, value) VALUES ('lastUpdateId', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (rows[2],))
+			self.writeConnection.executemany("INSERT INTO users (user_id, username, dm_allowed) VALUES (?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, dm_allowed = excluded.dm_allowed", userRows)
+			self.writeConnection.executemany("INSERT INTO memberships (group_id, user_id, is_admin) VALUES (?, ?, ?) ON CONFLICT (group_id, user_id) DO UPDATE SET is_admin = excluded.is_admin", membershipRows)
+
+
+def storedBoolean(value):  # sqlite hands booleans back as 0/1. None ("don't know yet") stays None
+	return None if value is None else bool(value)
+
+
+def openCacheStore():
+	if telegramConfig["cacheStore"] == "sqlite":
+		return SqliteCacheStore(telegramConfig["cacheDatabaseFile"])
+	if telegramConfig["cacheStore"] != "json":
+		printLog("Config WARNING", "Unknown cacheStore %s, using json", telegramConfig["cacheStore"])
+	return JsonCacheStore()
+
+
+def markCacheDirty(userId=None, groupId=None):
+	# called with cacheLock held whenever the cache changes. the write itself happens later, on the persister thread
+	global cacheDirtyCount
+	cacheDirtyCount += 1
+	if userId is not None:  # row-level stores only write out what's been touched
+		cacheDirtyUsers.add(userId)
+		if groupId is not None:
+			cacheDirtyMemberships.add((groupId, userId))
+	if cacheDirtyCount >= telegramConfig["cacheFlushDirtyThreshold"]:
+		cacheFlushEvent.set()  # lots of changes piling up (big group seen for the first time?), don't wait for the interval
+
+
+def flushCache(reason="interval"):
+	# snapshot the cache under the lock, then serialize and write it without holding anybody else up
+	global cacheDirtyCount, cacheOffsetDirty
+	with cacheFlushLock:  # shutdown and the persister thread could both try at once
+		with cacheLock:
+			if cacheDirtyCount == 0 and not cacheOffsetDirty:
+				return False
+			flushedChanges = cacheDirtyCount
+			cacheDirtyCount = 0
+			cacheOffsetDirty = False
+			dirtyUsers = cacheDirtyUsers.copy()
+			dirtyMemberships = cacheDirtyMemberships.copy()
+			cacheDirtyUsers.clear()
+			cacheDirtyMemberships.clear()
+			cacheSnapshot = cacheStore.snapshot(telegramCache, dirtyUsers, dirtyMemberships)
+		flushStart = monotonic()
+		try:
+			cacheStore.write(cacheStore.serialize(cacheSnapshot))
+		except Exception:
+			with cacheLock:
+				cacheDirtyCount += flushedChanges  # try again next time around
+				cacheOffsetDirty = True
+				cacheDirtyUsers.update(dirtyUsers)
+				cacheDirtyMemberships.update(dirtyMemberships)
+			raise
+		flushSeconds = monotonic() - flushStart
+		cacheFlushStats["flushes"] += 1
+		cacheFlushStats["changes"] += flushedChanges
+		cacheFlushStats["lastFlushSeconds"] = flushSeconds
+		cacheFlushStats["totalFlushSeconds"] += flushSeconds
+		cacheFlushStats["maxFlushSeconds"] = max(cacheFlushStats["maxFlushSeconds"], flushSeconds)
+		observeMetric("bridge_cache_flush_seconds", flushSeconds)
+		printLog("Cache", "Saved cache (%s, %d changes, flush #%d took %.1fms)", reason, flushedChanges, cacheFlushStats["flushes"], flushSeconds * 1000)
+		return True
+
+
+def cachePersister():
+	# background thread. flushes the dirty cache every cacheFlushIntervalSeconds, or sooner if enough changes pile up
+	while True:
+		thresholdReached = cacheFlushEvent.wait(telegramConfig["cacheFlushIntervalSeconds"])
+		cacheFlushEvent.clear()
+		try:
+			flushCache("threshold" if thresholdReached else "interval")
+		except Exception as error:
+			printLog("Cache ERROR", "Failed to save cache: " + str(error))
 
 
 def loadConfig(file="./configuration.json"):
 	# load configuration
-	if not os.path.exists(file):
 
-		# example configuration which is changeable from telegram via the configuration command.
-		exampleConfig = {
-			"prefixTelegramUsernamesWithAtSign": False,  # bot will see @usernames as actual @username rather than just username
-			"stripAllAtSignsFromBotText": True,  # remove any exact '@'s that come from the bot from the text to prevent pings
-			"forceConvertUsernamesToAtUsernames": False  # overrides stripAllAtSignsFromBotText, but only enables for usernames in that particular channel.
-		}
+	# example configuration which is changeable from telegram via the configuration command.
+	exampleConfig = {
+		"prefixTelegramUsernamesWithAtSign": False,  # bot will see @usernames as actual @username rather than just username
+		"stripAllAtSignsFromBotText": True,  # remove any exact '@'s that come from the bot from the text to prevent pings
+		"forceConvertUsernamesToAtUsernames": False,  # overrides stripAllAtSignsFromBotText, but only enables for usernames in that particular channel.
+		"adminCacheTtlSeconds": 300,  # how long a group's fetched admin list is trusted before it's refreshed in the background
+		"groupRefreshWorkers": 4,  # threads fetching admin lists and member counts, for the startup warm-up and TTL refreshes
+		"groupRefreshRequestsPerSecond": 10,  # ... and the API calls they may make between them
+		"joinNamesWaitSeconds": 3,  # on the first JOIN to a group the bridge hasn't fetched yet, how long NAMES waits for it. 0 doesn't wait
+		"cacheFlushIntervalSeconds": 5,  # how long cache changes may sit in memory before they're written to disk
+		"cacheFlushDirtyThreshold": 500,  # ... unless this many changes pile up first
+		"ircPingIntervalSeconds": 120,  # how often the IRC client is PINGed. two intervals of silence and it's dropped
+		"ircMaxLineLength": 8703,  # 512 bytes of IRC line plus 8191 of IRCv3 message tags. anything longer is dropped
+		"ircWriteBufferBytes": 262144,  # past this much unread output, the IRC client is considered slow and we stop writing to it
+		"ircSendQueueLimit": 10000,  # lines a stalled IRC client may have queued before it's dropped, and chunks telegram-side threads can have in flight before they have to wait...
+		"ircSendBlockSeconds": 30,  # ... and how long they wait before the line is dropped
+		"telegramGroupMessagesPerMinute": 20,  # telegram's flood limits. messages over these are queued, not sent
+		"telegramGroupMessageBurst": 3,
+		"telegramPrivateMessagesPerSecond": 1,
+		"telegramGlobalMessagesPerSecond": 30,
+		"telegramCoalesceWindowSeconds": 0.5,  # PRIVMSG lines to the same place this close together go out as one telegram message. 0 turns this off
+		"telegramOutboxLimit": 1000,  # most messages that can be waiting to go out to telegram at once
+		"telegramSendWorkers": 4,  # messages to different chats that can be on their way to telegram at once
+		"telegramInboundWorkers": 4,  # updates from different chats that can be handled at once. each chat's stay in order
+		"ircReplayBufferLines": 200,  # chat lines kept per channel/DM while no IRC client is connected, replayed when it's back
+		"telegramBacklogMaxAgeSeconds": 0,  # on restart, skip messages that waited longer than this. 0 bridges the whole backlog
+		"telegramOutboxOverflowPolicy": "dropOldest",  # "dropOldest" drops the oldest queued PRIVMSG to make room, "dropNewest" refuses the new one
+		"logLevel": "INFO",  # DEBUG, INFO, WARNING, ERROR or CRITICAL
+		"logCategoryLevels": {},  # per-category overrides, like {"Cache": "WARNING", "Chat": "DEBUG"}. categories are the first word of the log tag, bridged messages are "Chat"
+		"logFormat": "text",  # "text" for the usual log lines, "json" for one JSON object per line
+		"logFile": "",  # write the log here instead of to stdout
+		"cacheStore": "json",  # "json" keeps everything in usercache.json, "sqlite" keeps it in cacheDatabaseFile and only loads what's in use
+		"cacheDatabaseFile": "./usercache.sqlite3"  # created, and filled from usercache.json if there is one, on first start with the sqlite store
+	}
 
+	if not os.path.exists(file):
 		with open(file, "w") as filehandle:
 			json.dump(exampleConfig, filehandle, sort_keys=True, indent=4)
 			printLog("Config", "WARNING! Created new config!")
@@ -318,7 +1561,9 @@ def loadConfig(file="./configuration.json"):
 		with open(file, "r") as filehandle:
 			loadedcontents = json.load(filehandle)
 			printLog("Config", "Loaded config.")
-			return loadedcontents
+		for configKey, configDefault in exampleConfig.items():  # older configs won't have newer options. fill them in.
+			loadedcontents.setdefault(configKey, configDefault)
+		return loadedcontents
 
 
 def saveConfig(contents, file="./configuration.json"):
@@ -343,6 +1588,20 @@ def loadOrCreateSecretConfig(file="configuration_secrets.ini"):
 		exampleSecretConfig["IRC Configuration"]["Connection Password"] = "exampleSecureConnectionPassword"
 		exampleSecretConfig["Telegram Configuration"] = {}
 		exampleSecretConfig["Telegram Configuration"]["Secret Token"] = "exampleTelegramSecretToken"
+		exampleSecretConfig["Telegram Configuration"]["Update Mode"] = "polling"  # or "webhook"
+		exampleSecretConfig["Telegram Configuration"]["API Base URL"] = "https://api.telegram.org/bot"  # the token gets appended. point it at a local Bot API server or a stand-in
+		exampleSecretConfig["Telegram Sender Pool"] = {}
+		exampleSecretConfig["Telegram Sender Pool"]["Extra Tokens"] = ""  # comma separated tokens of more bots in the same groups, to spread outgoing messages over
+		exampleSecretConfig["Webhook Configuration"] = {}
+		exampleSecretConfig["Webhook Configuration"]["Listen Address"] = "127.0.0.1"
+		exampleSecretConfig["Webhook Configuration"]["Listen Port"] = "8443"
+		exampleSecretConfig["Webhook Configuration"]["Path"] = "/telegram-webhook"
+		exampleSecretConfig["Webhook Configuration"]["Public URL"] = ""  # empty: don't register with telegram, just listen
+		exampleSecretConfig["Webhook Configuration"]["Secret Token"] = "exampleWebhookSecretToken"
+		exampleSecretConfig["Metrics Configuration"] = {}
+		exampleSecretConfig["Metrics Configuration"]["Enabled"] = "False"
+		exampleSecretConfig["Metrics Configuration"]["Listen Address"] = "127.0.0.1"
+		exampleSecretConfig["Metrics Configuration"]["Listen Port"] = "9464"
 		with open(file + ".example", "w") as exampleSecretConfigFile:
 			exampleSecretConfig.write(exampleSecretConfigFile)
 		printLog("FATAL ERROR", "Secrets Configuration was not present! Generating an example. Please rename it to " + file + " after you have filled it out.")
@@ -359,331 +1618,914 @@ def loadOrCreateSecretConfig(file="configuration_secrets.ini"):
 		returningSecretConfig["ircPort"] = secretConfigObject["IRC Configuration"].getint("Listen Port")
 		returningSecretConfig["ircSecure"] = secretConfigObject["IRC Configuration"].getboolean("Listen via SSL")
 		returningSecretConfig["ircPass"] = secretConfigObject["IRC Configuration"]["Connection Password"]
+		# webhook settings came later, so older files won't have them
+		returningSecretConfig["telegramApiBaseUrl"] = secretConfigObject.get("Telegram Configuration", "API Base URL", fallback="https://api.telegram.org/bot")
+		returningSecretConfig["telegramExtraTokens"] = [extraToken.strip() for extraToken in secretConfigObject.get("Telegram Sender Pool", "Extra Tokens", fallback="").replace("\n", ",").split(",") if extraToken.strip()]
+		returningSecretConfig["telegramUpdateMode"] = secretConfigObject.get("Telegram Configuration", "Update Mode", fallback="polling").strip().lower()
+		returningSecretConfig["webhookHost"] = secretConfigObject.get("Webhook Configuration", "Listen Address", fallback="127.0.0.1")
+		returningSecretConfig["webhookPort"] = secretConfigObject.getint("Webhook Configuration", "Listen Port", fallback=8443)
+		returningSecretConfig["webhookPath"] = secretConfigObject.get("Webhook Configuration", "Path", fallback="/telegram-webhook")
+		returningSecretConfig["webhookUrl"] = secretConfigObject.get("Webhook Configuration", "Public URL", fallback="")
+		returningSecretConfig["webhookSecret"] = secretConfigObject.get("Webhook Configuration", "Secret Token", fallback="")
+		returningSecretConfig["metricsEnabled"] = secretConfigObject.getboolean("Metrics Configuration", "Enabled", fallback=False)
+		returningSecretConfig["metricsHost"] = secretConfigObject.get("Metrics Configuration", "Listen Address", fallback="127.0.0.1")
+		returningSecretConfig["metricsPort"] = secretConfigObject.getint("Metrics Configuration", "Listen Port", fallback=9464)
 
 		# and return it.
 		return returningSecretConfig
 
 
+def startTelegramUpdates():  # start receiving telegram updates, by long polling or by webhook
+	global telegramUpdatesStarted
+	if telegramUpdatesStarted:
+		return
+	telegramUpdatesStarted = True
+	with cacheLock:
+		resumeAfter = telegramCache.get("lastUpdateId")
+	if telegramSecretConfig["telegramUpdateMode"] != "webhook":
+		if resumeAfter is None:  # first run: nothing to resume, start fresh
+			updater.start_polling(poll_interval=0, drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)  # chat_member updates are opt-in. long polling waits server-side, no need to sleep between polls
+			printLog("Telegram", "Telegram interface polling in separate thread. Link established!")
+		else:
+			threading.Thread(target=catchUpTelegramUpdates, args=(resumeAfter,), name="telegramCatchUp", daemon=True).start()
+		return
+	# webhook mode: our own listener feeds the updater's queue, so the dispatcher has to be started by hand
+	webhookServer = ThreadingHTTPServer((telegramSecretConfig["webhookHost"], telegramSecretConfig["webhookPort"]), TelegramWebhookHandler)
+	threading.Thread(target=webhookServer.serve_forever, name="webhookListener", daemon=True).start()
+	threading.Thread(target=dispatcher.start, name="dispatcher", daemon=True).start()
+	if updater.job_queue:
+		updater.job_queue.start()
+	printLog("Telegram", "Webhook listener on " + telegramSecretConfig["webhookHost"] + ":" + str(telegramSecretConfig["webhookPort"]) + telegramSecretConfig["webhookPath"])
+	if not telegramSecretConfig["webhookSecret"]:
+		printLog("Telegram", "WARNING! No webhook secret token set, accepting updates from anyone who can reach the listener.")
+	if telegramSecretConfig["webhookUrl"]:
+		threading.Thread(target=registerTelegramWebhook, args=(resumeAfter is None,), name="webhookRegistration", daemon=True).start()  # we're on the IRC loop, don't wait on telegram here
+	else:
+		printLog("Telegram", "No public webhook URL set, not registering with telegram. POST updates to the listener yourself.")
+
+
+def registerTelegramWebhook(dropPendingUpdates):
+	# with a saved offset, telegram is left to deliver whatever it queued while we were down
+	webhookOptions = {}
+	if telegramSecretConfig["webhookSecret"]:
+		webhookOptions["secret_token"] = telegramSecretConfig["webhookSecret"]  # passed raw so older library versions still send it
+	try:
+		telegramBotInterface.set_webhook(url=telegramSecretConfig["webhookUrl"], allowed_updates=Update.ALL_TYPES, drop_pending_updates=dropPendingUpdates, api_kwargs=webhookOptions)
+	except Exception as error:
+		printLog("Telegram ERROR", "Could not register webhook at " + telegramSecretConfig["webhookUrl"] + ": " + str(error))
+		return
+	printLog("Telegram", "Webhook registered at " + telegramSecretConfig["webhookUrl"] + ". Link established!")
+
+
+def catchUpTelegramUpdates(resumeAfter):
+	# background thread. fetch everything telegram queued since the saved offset in full batches, with no polling delay,
+	# and hand it to the dispatcher ahead of live traffic. then poll as usual from where the backlog ended
+	maxAge = telegramConfig["telegramBacklogMaxAgeSeconds"]
+	nextOffset = resumeAfter + 1
+	queuedUpdates = 0
+	skippedUpdates = 0
+	catchUpStart = monotonic()
+	while True:
+		try:
+			backlog = updater.bot.get_updates(offset=nextOffset, limit=100, timeout=0, allowed_updates=Update.ALL_TYPES)
+		except Exception as error:
+			printLog("Telegram WARNING", "Could not fetch the update backlog, polling will pick it up: %s", error)
+			break
+		if not backlog:
+			break
+		for update in backlog:
+			if maxAge > 0 and update.effective_message is not None and update.effective_message.date is not None and time() - update.effective_message.date.timestamp() > maxAge:
+				skippedUpdates += 1
+			else:
+				updater.update_queue.put(update)
+				queuedUpdates += 1
+		nextOffset = backlog[-1].update_id + 1
+	printLog("Telegram", "Caught up on %d updates since the last run (%d skipped as older than %ds) in %.2fs", queuedUpdates, skippedUpdates, maxAge, monotonic() - catchUpStart)
+	updater.last_update_id = nextOffset
+	updater.start_polling(poll_interval=0, allowed_updates=Update.ALL_TYPES)
+	printLog("Telegram", "Telegram interface polling in separate thread. Link established!")
+
+
+class TelegramWebhookHandler(BaseHTTPRequestHandler):  # receives update POSTs from telegram (or from a recording)
+	def do_POST(self):
+		if self.path != telegramSecretConfig["webhookPath"]:
+			self.send_error(404)
+			return
+		secret = telegramSecretConfig["webhookSecret"]
+		if secret and not hmac.compare_digest(self.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("utf-8"), secret.encode("utf-8")):
+			printLog("Telegram", "Rejected webhook request from " + self.client_address[0] + ": bad secret token")
+			self.send_error(403)
+			return
+		length = int(self.headers.get("Content-Length") or 0)
+		if length <= 0 or length > webhookMaxBodyBytes:
+			self.send_error(413 if length > 0 else 400)
+			return
+		try:
+			rawUpdates = json.loads(self.rfile.read(length))
+		except ValueError:
+			self.send_error(400)
+			return
+		if isinstance(rawUpdates, dict):  # telegram sends one update per request, recordings may batch them in a list
+			rawUpdates = [rawUpdates]
+		elif not isinstance(rawUpdates, list):
+			self.send_error(400)
+			return
+		updates = []
+		for rawUpdate in rawUpdates:  # the whole batch has to decode before any of it is queued
+			if not isinstance(rawUpdate, dict):
+				self.send_error(400)
+				return
+			try:
+				update = Update.de_json(rawUpdate, updater.bot)
+			except Exception as error:
+				printLog("Telegram", "Rejected webhook request from " + self.client_address[0] + ": undecodable update (" + type(error).__name__ + ")")
+				self.send_error(400)
+				return
+			if update is not None:
+				updates.append(update)
+		for update in updates:
+			updater.update_queue.put(update)
+		self.send_response(200)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def log_message(self, format, *args):  # requests are logged by the dispatcher already, keep stderr quiet
+		pass
+
+
 def shutdownBridge(irc_socket=None, messageCategory="FATAL ERROR", message="Exiting!", exitcode=1):
 	printLog(messageCategory, message)
+	try:
+		flushCache("shutdown")  # last chance. nothing after the SIGKILL gets to run
+	except Exception as error:
+		printLog("Cache ERROR", "Failed to save cache on shutdown: " + str(error))
 	if irc_socket is not None:
 		irc_socket.close()
+	logListener.stop()  # flush out the queued log lines, the SIGKILL won't wait for them
 	# updater.stop()
 	# sys.exit(exitcode)
 	os.kill(os.getpid(), signal.SIGKILL)
 
 
-def parseIrcMessages(line=None):
+class IrcMessage:
+	# one parsed IRC line: [@tags] [:prefix] COMMAND [params...] [:trailing]
+	__slots__ = ("tags", "prefix", "command", "params", "hasTrailing")
+
+	def __init__(self, tags, prefix, command, params, hasTrailing=False):
+		self.tags = tags  # dict of IRCv3 message tags, or None
+		self.prefix = prefix  # source, without the colon, or None
+		self.command = command  # always uppercase
+		self.params = params  # trailing parameter last, exactly as sent
+		self.hasTrailing = hasTrailing  # whether the last parameter came after a " :"
+
+	def textFrom(self, index):
+		# message text starting at params[index]. old bots often send "PRIVMSG #chan hello world" without the colon,
+		# and mean all of it
+		if self.hasTrailing:
+			return self.params[-1] if len(self.params) > index else ""
+		return " ".join(self.params[index:])
+
+
+def parseIrcTags(rawTags):
+	# "a=b;c;d=e\sf" -> { "a": "b", "c": "", "d": "e f" }
+	tags = {}
+	for rawTag in rawTags.split(";"):
+		if rawTag == "":
+			continue
+		tagKey, separator, tagValue = rawTag.partition("=")
+		if "\\" in tagValue:
+			tagValue = re.sub(r"\\(.?)", lambda escape: ircTagUnescapes.get(escape.group(1), escape.group(1)), tagValue)
+		tags[tagKey] = tagValue
+	return tags
+
+
+def parseIrcLine(line):
+	# returns an IrcMessage, or None if there's no command in there at all
+	tags = None
+	prefix = None
+	position = 0
+	if line.startswith("@"):
+		position = line.find(" ")
+		if position == -1:
+			return None
+		tags = parseIrcTags(line[1:position])
+		while line.startswith(" ", position):
+			position += 1
+	if line.startswith(":", position):
+		prefixEnd = line.find(" ", position)
+		if prefixEnd == -1:
+			return None
+		prefix = line[position + 1:prefixEnd]
+		position = prefixEnd + 1
+	trailingStart = line.find(" :", position)
+	if trailingStart == -1:
+		params = line[position:].split()
+	else:
+		params = line[position:trailingStart].split()
+	if not params:
+		return None
+	command = params.pop(0).upper()  # commands are case-insensitive
+	if trailingStart != -1:
+		params.append(line[trailingStart + 2:])  # the trailing parameter keeps every space it was sent with
+	return IrcMessage(tags, prefix, command, params, trailingStart != -1)
+
+
+def parseIrcMessages(client, line=None):
+	# parse one line from the client and hand it to whatever is registered for its command in ircCommandHandlers
 	if line is None:
 		printLog("IRC WARNING", "Parse error: Nothing sent to parsing system.")
 		return
-	if line[0] == "PING":  # ping responses, the bread and butter of any ircd
-		sendToIrc(":telegram.irc.bridge PONG telegram.irc.bridge :" + " ".join(line[1:]))
-
-	elif line[0] == "USER":  # initial username login procedure
-		ircuser["user"] = line[1]  # we really dont care as this is a single-connection IRCd
-		ircuser["real"] = " ".join(line[4:]).lstrip(":")
-		ircuser["host"] = line[3]
-		printLog("IRC", "Client attempting login...")
-		if ircuser["nick"] is not None and ircuser["welcome"] is None:  # this is a fresh connection. treat it like one!
-			ircuser["welcome"] = True
-			printLog("IRC", "Client logged in successfully!")
-			# initial informational components
-			sendToIrc(":telegram.irc.bridge 001 " + ircuser["nick"] + " :Welcome to the telegram IRC bridge " + ircuser["nick"] + "!" + ircuser["user"] + "@" + ircuser["host"])  # welcome message
-			sendToIrc(":telegram.irc.bridge 002 " + ircuser["nick"] + " :Your host is telegram.irc.bridge, running telegramircbridge-v" + bridgeVersion)  # more information
-			sendToIrc(":telegram.irc.bridge 003 " + ircuser["nick"] + " :This server was created in the beginning of time. It only just now accepts connections.")  # server creation date
-			sendToIrc(":telegram.irc.bridge 004 " + ircuser["nick"] + " Telegram telegramircbridge-v" + bridgeVersion + " Biwxs Yqaohvrnmtsi")  # server short-name, software version, usermodes, channelmodes, parametered channel modes. (channel modes here should not be parsed by clients apparently)
-			printLog("IRC", "Finished sending initial server specifications")
-
-			# capabilities, server information and other pertinent details
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " AWAYLEN=200 :are supported by this server")  # not supported
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " CASEMAPPING=rfc1459 :are supported by this server")  # also not supported
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " CHANMODES=,,,imnrst :are supported by this server")  # updated to match our actual capabilities as a server
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " CHANNELLEN=32 :are supported by this server")  # not enforced
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " CHANTYPES=# :are supported by this server")
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " CHARSET=utf-8 :are supported by this server")  # not enforced but required by clients
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " KICKLEN=40 :are supported by this server")  # kicks are not supported
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " MAXBANS=1 :are supported by this server")  # modes in general are not supported
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " MAXCHANNELS=1 :are supported by this server")
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " MAXPARA=1 :are supported by this server")
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " MAXTARGETS=1 :are supported by this server")
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " MODES=1 :are supported by this server")
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " NAMESX :are supported by this server")
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " NETWORK=Telegram :are supported by this server")
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " NICKLEN=32 :are supported by this server")  # not enforced
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " PREFIX=(Yqaohv)!~&@%+ :are supported by this server")  # planned expanded support
-			sendToIrc(":telegram.irc.bridge 005 " + ircuser["nick"] + " UHNAMES :are supported by this server")  # implemented
-			printLog("IRC", "Finished sending CAPAB list")
-
-			# and, since this IS technically IRC, let's send a big-ass ASCII art image, as is tradition.
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :telegram.irc.bridge message of the day")  # motd start
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTTTTTTTTTTTT0kxdoooooooddkTTTTTTTTTTTTTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTTTTTTTko:'..              .';lx0TTTTTTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTTTkl,.                         .'cxTTTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTc'                                 .:kTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTx;                                       'dTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTk;                                           'xTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTl.                                              :0TTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTT0;                                                 'kTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTT'                                                   .xTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTT0'                                    .,coo;           .xTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTT:                                .,cdkTTTTTd.           '0TTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTd.                          .;cldTTTTTTTTTTT:             cTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TT;                     .';ldTTTTTTTTkxkTTTTTT'             .TTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TT.                .':ox0TTTTTTTTTxccd0TTTTTTl               lTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- To            .':okTTTTTTTTTT0d;'';dTTTTTTTTT,               cTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- Tl           ,TTTTTTTTTTTTTo;..,lxTTTTTTTTTTd.               :TT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- Tx.          .';ldk0TTTTl,. .;kTTTTTTTTTTTTT;                cTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- T0,                ..'.   .:TTTTTTTTTTTTTTTk.               .dTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTc                      .kTTTTTTTTTTTTTTTTc                ,TTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTT.                     ;TTTTTTTTTTTTTTTT0'               .dTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTo.                    :TTTx::okTTTTTTTTl                :TTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTl                    :0d,     'lTTTTTT;               ;TTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTl                   ..         .;d0Tl.              ;TTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTd.                               ..               cTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTT;                                             'xTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTx,                                         .oTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTk;.                                    ,oTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTT0o,.                              'ckTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTTTT0dc,.                     .':oTTTTTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTTTTTTTTTkdo:,''........',;ldk0TTTTTTTTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT ")
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- Telegram IRC Bridge v" + bridgeVersion)
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- Rules: Do not spam. Maximum 20 API calls (messages) per minute.")  # as per telegram API documentation.
-			sendToIrc(":telegram.irc.bridge 375 " + ircuser["nick"] + " :- Other rules up to interpretation by Telegram itself.")
-			sendToIrc(":telegram.irc.bridge 376 " + ircuser["nick"] + " :End of message of the day.")  # end of MOTD
-			sendToIrc(":telegram.irc.bridge 302 " + ircuser["nick"] + " :" + ircuser["nick"] + "=+" + ircuser["user"] + "@" + ircuser["host"])  # send hostname reported by IRC server, that way we're sure we've got it right
-			printLog("IRC", "Finished sending MOTD")
-			printLog("IRC", "Finished sending all initial connection information")
+	message = parseIrcLine(line)
+	if message is None:
+		printLog("IRC WARNING", "Parse error: |" + line + "|")
+		return
+	commandHandler = ircCommandHandlers.get(message.command)
+	if commandHandler is None:  # other garbage info coming in. print here.
+		printLog("IRC", "GARBAGE: |" + line + "|")
+		return
+	if not client.registered and message.command not in ircRegistrationCommands:
+		sendToIrc(client, ":telegram.irc.bridge 451 " + str(client.nick or "*") + " :You have not registered")
+		return
+	if len(message.params) < commandHandler[1]:
+		sendToIrc(client, ":telegram.irc.bridge 461 " + str(client.nick or "*") + " " + message.command + " :Not enough parameters")
+		return
+	commandHandler[0](client, message)
+
+
+def handleIrcPing(client, message):  # ping responses, the bread and butter of any ircd
+	sendToIrc(client, ":telegram.irc.bridge PONG telegram.irc.bridge :" + (message.params[-1] if message.params else "telegram.irc.bridge"))
+
+
+def handleIrcPass(client, message):  # connection password, checked once NICK and USER are in
+	if client.registered:
+		sendToIrc(client, ":telegram.irc.bridge 462 " + client.nick + " :You may not reregister")
+		return
+	client.password = message.params[0]
+
+
+def handleIrcUser(client, message):  # initial username login procedure
+	client.user = message.params[0]  # we really dont care, it's only ever echoed back
+	client.real = message.params[3]
+	client.host = message.params[2]
+	printLog("IRC", "Client attempting login...")
+	completeIrcRegistration(client)
+
+
+def completeIrcRegistration(client):
+	# once we have NICK and USER, and any CAP negotiation is over, the client is logged in
+	if client.nick is not None and client.user is not None and not client.registered and not client.capNegotiating:  # this is a fresh connection. treat it like one!
+		if telegramSecretConfig["ircPass"] and not hmac.compare_digest((client.password or "").encode("utf-8"), telegramSecretConfig["ircPass"].encode("utf-8")):
+			printLog("IRC WARNING", "Client %s gave the wrong connection password, disconnecting it", client.nick)
+			sendToIrc(client, ":telegram.irc.bridge 464 " + client.nick + " :Password incorrect")
+			client.disconnect("Bad password")
+			return
+		with ircReplayLock:
+			client.registered = True
+			ircRegisteredClients.add(client)
+		printLog("IRC", "Client %s logged in successfully!", client.nick)
+		# initial informational components
+		sendToIrc(client, ":telegram.irc.bridge 001 " + client.nick + " :Welcome to the telegram IRC bridge " + client.nick + "!" + client.user + "@" + client.host)  # welcome message
+		client.queueOutput(renderIrcWelcomeBurst(client.nick))  # server specifications, CAPAB list and MOTD, all in one go
+		sendToIrc(client, ":telegram.irc.bridge 302 " + client.nick + " :" + client.nick + "=+" + client.user + "@" + client.host)  # send hostname reported by IRC server, that way we're sure we've got it right
+		printLog("IRC", "Finished sending all initial connection information")
+		for bufferedDestination in [bufferedDestination for bufferedDestination in ircReplayBuffers if not bufferedDestination.startswith("#")]:
+			replayIrcBuffer(client, bufferedDestination)  # DMs that came in while we were disconnected. channels wait for their JOIN
+		if not telegramUpdatesStarted:
 			printLog("Telegram", "Attempting Telegram interface startup")
-			# there. just like home.		
-			# updater.start_polling(poll_interval=0.2, clean=True)
-			updater.start_polling(poll_interval=0.2, clean=True)
-			printLog("Telegram", "Telegram interface polling in separate thread. Link established!")
+		# there. just like home.		
+		startTelegramUpdates()
 
-	elif line[0] == "NICK":  # nickname being changed
-		ircuser["nick"] = line[1]
-		printLog("IRC", "Client changed nick to " + ircuser["nick"])
-
-	elif line[0] == "PART":  # client leaving a channel
-		ircuser["channels"] = list(filter((line[1]).__ne__, ircuser["channels"]))  # taken from stackoverflow, it's arcane. removes all entries of our parting channel
-		sendToIrc(":" + ircuser["nick"] + "!" + ircuser["user"] + "@telegram.irc.bridge PART :" + " ".join(line[2:]))
-
-	elif line[0] == "KICK":  # KICKs from client. Ignore them.
-		printLog("IRC", "Client tried to kick " + line[2] + " from " + line[1])
-		sendToIrc(":telegram.irc.bridge 482 " + ircuser["nick"] + " " + line[1] + " :You must be a channel half-operator to kick users.")
-
-	elif line[0] == "REMOVE":  # inspircd-style /REMOVE command. ignore it too. Normally failed attempts to remove are handled with a notice saying so, but i guess this is fine
-		printLog("IRC", "Client tried to remove " + line[2] + " from " + line[1])
-		sendToIrc(":telegram.irc.bridge 482 " + ircuser["nick"] + " " + line[1] + " :You must be a channel half-operator to kick users.")
-
-	elif line[0] == "QUIT":  # client disconnecting gracefully
-		# shutdownBridge(irc_socket,"IRC","Client disconnecting.",0)
-		printLog("IRC", "Client disconnected. Ignoring until client closes the socket themselves.")
-
-	elif line[0] == "JOIN":  # client joining channel
-		attemptedChannels = line[1].split(",")
-		for channel in attemptedChannels:
-			convertedGroupId = str(channel.lstrip("#"))
-			sendToIrc(":" + ircuser["nick"] + "!" + ircuser["user"] + "@" + "telegram.irc.bridge JOIN :" + channel)
-			ircuser["channels"].append(channel)
-			printLog("IRC", "Client joining pseudochannel #" + str(convertedGroupId))
-
-			if convertedGroupId in telegramCache["groups"].keys():
-				allListedUsers = ":" + ircuser["nick"]
-				for cachedUserId, cachedUserIsAdmin in telegramCache["groups"][convertedGroupId].items():
-					if telegramCache["users"][cachedUserId][0] != "None":
-						if cachedUserIsAdmin:
-							allListedUsers = allListedUsers + " @" + prefixUsernames() + telegramCache["users"][cachedUserId][0]
-						else:
-							allListedUsers = allListedUsers + " +" + prefixUsernames() + telegramCache["users"][cachedUserId][0]
-					else:
-						printLog("Cache WARNING", "Skipped @-less Telegram user " + str(cachedUserId) + " in cache")
-				sendToIrc(":telegram.irc.bridge 353 " + ircuser["nick"] + " @ " + line[1] + allListedUsers)
-			else:
-				sendToIrc(":telegram.irc.bridge 353 " + ircuser["nick"] + " @ " + channel + " :" + ircuser["nick"])
-				printLog("Cache WARNING", "Group cache for TG group " + str(convertedGroupId) + " nonexistent or empty, sending an empty channel JOIN-associated NAMES reply")
-			sendToIrc(":telegram.irc.bridge 366 " + ircuser["nick"] + " " + channel + " End of /NAMES list.")
-
-	elif line[0] == "NAMES":  # client MANUALLY requesting NAMES. NAMES are also sent automatically on successful JOIN to a channel, but not what we're doing here.
-		convertedGroupId = str(line[1].lstrip("#"))
-		if convertedGroupId in telegramCache["groups"].keys():
-			allListedUsers = ":" + ircuser["nick"]
-			for cachedUserId, cachedUserIsAdmin in telegramCache["groups"][convertedGroupId].items():
-				if telegramCache["users"][cachedUserId][0] != "None":
-					if cachedUserIsAdmin:
-						allListedUsers = allListedUsers + " @" + prefixUsernames() + telegramCache["users"][cachedUserId][0]
-					else:
-						allListedUsers = allListedUsers + " +" + prefixUsernames() + telegramCache["users"][cachedUserId][0]
+
+def handleIrcPong(client, message):  # reply to our keepalive PING. receiving it at all was the point
+	pass
+
+
+def handleIrcNick(client, message):  # nickname being changed
+	for otherClient in ircClients:
+		if otherClient is not client and otherClient.nick is not None and otherClient.nick.lower() == message.params[0].lower():
+			sendToIrc(client, ":telegram.irc.bridge 433 " + (client.nick or "*") + " " + message.params[0] + " :Nickname is already in use")
+			return
+	client.nick = message.params[0]
+	printLog("IRC", "Client changed nick to " + client.nick)
+	completeIrcRegistration(client)
+
+
+def handleIrcCap(client, message):  # IRCv3 capability negotiation. all we offer is server-time, for replayed messages
+	subcommand = message.params[0].upper()
+	capTarget = client.nick or "*"
+	if subcommand == "LS":
+		if not client.registered:
+			client.capNegotiating = True  # hold off on the welcome until CAP END
+		sendToIrc(client, ":telegram.irc.bridge CAP " + capTarget + " LS :" + " ".join(ircSupportedCaps))
+	elif subcommand == "LIST":
+		sendToIrc(client, ":telegram.irc.bridge CAP " + capTarget + " LIST :" + " ".join(sorted(client.caps)))
+	elif subcommand == "REQ" and len(message.params) > 1:
+		requestedCaps = message.params[1].split()
+		if not client.registered:
+			client.capNegotiating = True
+		if all(requestedCap.lstrip("-") in ircSupportedCaps for requestedCap in requestedCaps):
+			for requestedCap in requestedCaps:
+				if requestedCap.startswith("-"):
+					client.caps.discard(requestedCap[1:])
 				else:
-					printLog("Cache WARNING", "Skipped @-less Telegram user " + str(cachedUserId) + " in cache")
-			sendToIrc(":telegram.irc.bridge 353 " + ircuser["nick"] + " @ " + line[1] + allListedUsers)
+					client.caps.add(requestedCap)
+			sendToIrc(client, ":telegram.irc.bridge CAP " + capTarget + " ACK :" + message.params[1])
 		else:
-			sendToIrc(":telegram.irc.bridge 353 " + ircuser["nick"] + " @ " + line[1] + " :" + ircuser["nick"])
-			printLog("Cache WARNING", "Group cache for TG group " + str(convertedGroupId) + " nonexistent or empty, sending an empty channel NAMES reply")
-		sendToIrc(":telegram.irc.bridge 366 " + ircuser["nick"] + " " + line[1] + " End of /NAMES list.")
-
-	elif line[0] == "WHO":  # client requesting WHO
-		convertedGroupId = str(line[1].lstrip("#"))
-		sendToIrc(":telegram.irc.bridge 352 " + ircuser["nick"] + " " + line[1] + " " + ircuser["user"] + " " + ircuser["host"] + " telegram.irc.bridge " + ircuser["nick"] + " H :0 " + ircuser["real"])
-		if convertedGroupId in telegramCache["groups"].keys():
-			for cachedUserId, cachedUserIsAdmin in telegramCache["groups"][convertedGroupId].items():
-				if telegramCache["users"][cachedUserId][0] != "None":
-					if cachedUserIsAdmin:
-						sendToIrc(":telegram.irc.bridge 352 " + ircuser["nick"] + " " + line[1] + " " + str(cachedUserId) + " telegram.irc.bridge telegram.irc.bridge " + prefixUsernames() + telegramCache["users"][cachedUserId][0] + " H@ :0 TelegramUser")
-					else:
-						sendToIrc(":telegram.irc.bridge 352 " + ircuser["nick"] + " " + line[1] + " " + str(cachedUserId) + " telegram.irc.bridge telegram.irc.bridge " + prefixUsernames() + telegramCache["users"][cachedUserId][0] + " H+ :0 TelegramUser")
-				else:
-					printLog("Compat WARNING", "Skipped @-less Telegram user " + str(cachedUserId) + " in cache")
+			sendToIrc(client, ":telegram.irc.bridge CAP " + capTarget + " NAK :" + message.params[1])
+	elif subcommand == "END":
+		client.capNegotiating = False
+		completeIrcRegistration(client)
+	else:
+		sendToIrc(client, ":telegram.irc.bridge 410 " + capTarget + " " + message.params[0] + " :Invalid CAP command")
+
+
+def handleIrcPart(client, message):  # client leaving a channel
+	partReason = ""
+	if len(message.params) > 1:
+		partReason = " :" + message.params[1]
+	for channel in message.params[0].split(","):
+		leaveIrcChannel(client, channel)
+		sendToIrc(client, ":" + client.nick + "!" + client.user + "@telegram.irc.bridge PART " + channel + partReason)
+
+
+def handleIrcKick(client, message):  # KICKs from client. Ignore them.
+	printLog("IRC", "Client tried to kick " + message.params[1] + " from " + message.params[0])
+	sendToIrc(client, ":telegram.irc.bridge 482 " + client.nick + " " + message.params[0] + " :You must be a channel half-operator to kick users.")
+
+
+def handleIrcRemove(client, message):  # inspircd-style /REMOVE command. ignore it too. Normally failed attempts to remove are handled with a notice saying so, but i guess this is fine
+	printLog("IRC", "Client tried to remove " + message.params[1] + " from " + message.params[0])
+	sendToIrc(client, ":telegram.irc.bridge 482 " + client.nick + " " + message.params[0] + " :You must be a channel half-operator to kick users.")
+
+
+def handleIrcQuit(client, message):  # client disconnecting gracefully
+	# shutdownBridge(irc_socket,"IRC","Client disconnecting.",0)
+	printLog("IRC", "Client quitting. Waiting for it to close the socket.")
+
+
+def handleIrcJoin(client, message):  # client joining channel
+	attemptedChannels = message.params[0].split(",")
+	for channel in attemptedChannels:
+		convertedGroupId = str(channel.lstrip("#"))
+		sendToIrc(client, ":" + client.nick + "!" + client.user + "@" + "telegram.irc.bridge JOIN :" + channel)
+		if channel in client.pendingJoins:
+			continue  # NAMES is already on its way
+		client.channels.add(channel)
+		printLog("IRC", "Client %s joining pseudochannel #%s", client.nick, convertedGroupId)
+		groupId = channelGroupId(channel)
+		if groupId is None or groupId >= 0:
+			groupFetched = True  # nothing to fetch for a channel that isn't a telegram group
 		else:
-			printLog("IRC", "WARNING! group cache for TG group " + str(convertedGroupId) + " nonexistent or empty, sending empty WHO reply")
-		sendToIrc(":telegram.irc.bridge 315 " + ircuser["nick"] + " " + line[1] + " End of /WHO list.")
-		printLog("IRC", "Client requested memberlist (WHO) of pseudochannel #" + str(convertedGroupId))
-
-	elif line[0] == "MODE":  # client trying to change MODEs
-		if line[1].startswith("#"):  # ... on a channel
-			if len(line) == 3:
-				# just checking or setting a channel mode of some kind, no targets specified
-
-				# various channel list checks
-				if line[2] == "+b":
-					sendToIrc(":telegram.irc.bridge 368 " + ircuser["nick"] + " " + line[1] + " :End of channel ban list")
-					printLog("IRC", "Sent empty ban list.")
-				if line[2] == "+e":
-					sendToIrc(":telegram.irc.bridge 349 " + ircuser["nick"] + " " + line[1] + " :End of channel exception list")
-					printLog("IRC", "Sent empty banexcept list.")
-				if line[2] == "+I":
-					sendToIrc(":telegram.irc.bridge 347 " + ircuser["nick"] + " " + line[1] + " :End of channel invite exception list")
-					printLog("IRC", "Sent empty invex list.")
-				if line[2] == "+g":
-					sendToIrc(":telegram.irc.bridge 940 " + ircuser["nick"] + " " + line[1] + " :End of channel spamfilter list")
-					printLog("IRC", "Sent empty spamfilter list.")
-
-				else:  # looks like it might be an actual mode change. better tell them to fuck off.
-					printLog("IRC", "Denied mode change.")
-					sendToIrc(":telegram.irc.bridge 482 " + ircuser["nick"] + " " + line[1] + " :You must have channel halfop access or above to set channel mode ")
-
-			else:  # ok it LOOKS like they're trying to set some kind of mode on the channel or someone. better just tell them to fuck themselves.
-				printLog("IRC", "Denied mode change (length check fail)")
-				sendToIrc(":telegram.irc.bridge 482 " + ircuser["nick"] + " " + line[1] + " :You must have channel halfop access or above to set channel mode ")  # but be kinda vague. this might be a problem with really convoluted bots that check 482 responses.
-			sendToIrc(":telegram.irc.bridge 324 " + ircuser["nick"] + " " + line[1] + " +nts")  # standard "no outside messages, no topic changes without ops, secret" mode line used by lots of ircds
-		elif line[1] == ircuser["nick"]:  # setting modes on itself. just echo it back.
-			sendToIrc(":" + ircuser["nick"] + "!" + ircuser["user"] + "@" + ircuser["host"] + " " + " ".join(line[0:]))
-			printLog("IRC", "Client set modes " + " ".join(line[2:]) + " on themself")
+			with adminCacheLock:
+				cachedAdmins = adminCache.get(str(groupId))
+			# a failed fetch holds off further waits for a TTL, a successful one for good (it's refreshed in the background)
+			groupFetched = cachedAdmins is not None and (cachedAdmins[1] is not None or monotonic() - cachedAdmins[0] < telegramConfig["adminCacheTtlSeconds"])
+		if not groupFetched and telegramConfig["joinNamesWaitSeconds"] > 0:
+			# a group we haven't asked telegram about yet. hold NAMES (and the channel's chat, which is buffered meanwhile)
+			# until its admins are in, rather than sending an empty list followed by a trickle of JOINs
+			requestAdminRefresh(groupId, True, telegramPriorityControl)
+			client.pendingJoins[channel] = ircLoop.call_later(telegramConfig["joinNamesWaitSeconds"], finishPendingJoin, client, channel)
 		else:
-			printLog("IRC", "Client tried to set modes on another user. Ignoring. (" + " ".join(line) + ")")
-
-	elif line[0] == "PRIVMSG":  # client messaging something
-		destinationChatId = None
-		messageType = None
-		if line[1].startswith("#"):  # this is a channel/group/thing
-			if int(line[1].lstrip("#")) < 0:
-				destinationChatId = str(line[1].lstrip("#"))
-				messageType = "Chan"
+			completeIrcJoin(client, channel)
+
+
+def completeIrcJoin(client, channel):
+	# subscribe the client to the channel's telegram output, then NAMES and whatever was buffered for it
+	with ircReplayLock:
+		ircChannelClients.setdefault(channel, set()).add(client)
+	sendNamesReply(client, channel)
+	replayIrcBuffer(client, channel)
+
+
+def finishPendingJoin(client, channel):
+	# event loop only. the warm-up came back, or we got tired of waiting for it
+	joinTimer = client.pendingJoins.pop(channel, None)
+	if joinTimer is None:
+		return  # parted, or already done
+	joinTimer.cancel()
+	if not client.transport.is_closing():
+		completeIrcJoin(client, channel)
+
+
+def finishGroupWarmup(groupId):
+	# event loop only
+	channel = "#" + groupId
+	for client in tuple(ircClients):
+		if channel in client.pendingJoins:
+			finishPendingJoin(client, channel)
+
+
+def leaveIrcChannel(client, channel):
+	client.channels.discard(channel)
+	joinTimer = client.pendingJoins.pop(channel, None)
+	if joinTimer is not None:
+		joinTimer.cancel()
+	with ircReplayLock:
+		channelClients = ircChannelClients.get(channel)
+		if channelClients is not None:
+			channelClients.discard(client)
+			if not channelClients:
+				del ircChannelClients[channel]
+
+
+def relayIrcChannelMessage(client, message):
+	# other clients in the channel see what this one said, like on any IRC server. telegram never echoes a bot's own messages
+	for otherClient in tuple(ircChannelClients.get(message.params[0], ())):
+		if otherClient is not client:
+			sendToIrc(otherClient, ":" + client.nick + "!" + client.user + "@" + client.host + " " + message.command + " " + message.params[0] + " :" + message.textFrom(1))
+
+
+def handleIrcNames(client, message):  # client MANUALLY requesting NAMES. NAMES are also sent automatically on successful JOIN to a channel, but not what we're doing here.
+	sendNamesReply(client, message.params[0])
+
+
+def channelGroupId(target):
+	# "#-100123" -> -100123. None for anything that isn't a telegram chat id (a nick, "#foo"), which is then just an empty channel
+	try:
+		return int(target.lstrip("#"))
+	except ValueError:
+		return None
+
+
+def lookupGroupMemberTokens(groupId):
+	# [ ( userId, token ), ... ] for a NAMES or WHO reply. empty for groups we know nothing about. shared, so read it, don't change it
+	if groupId is None:
+		return []
+	with cacheLock:
+		loadCachedGroup(groupId)
+		return listMemberTokens(groupId)
+
+
+def sendNamesReply(client, channel):
+	# 353s for everyone we know is in the group, packed into as few lines as fit under IRC's 512 byte limit, then the 366
+	convertedGroupId = str(channel.lstrip("#"))
+	memberTokens = [memberToken for memberUserId, memberToken in lookupGroupMemberTokens(channelGroupId(channel))]
+	if not memberTokens:
+		printLog("Cache WARNING", "Group cache for TG group " + convertedGroupId + " nonexistent or empty, sending an empty channel NAMES reply")
+	namesPrefix = ":telegram.irc.bridge 353 " + client.nick + " @ " + channel + " :"
+	namesRoom = ircLineLimit - len(namesPrefix.encode("utf-8"))
+	namesLines = []
+	lineTokens = [client.nick]
+	lineLength = len(client.nick.encode("utf-8"))
+	for memberToken in memberTokens:  # usernames are plain ASCII, so characters are bytes
+		if lineLength + 1 + len(memberToken) > namesRoom:
+			namesLines.append(namesPrefix + " ".join(lineTokens))
+			lineTokens = []
+			lineLength = -1
+		lineTokens.append(memberToken)
+		lineLength += 1 + len(memberToken)
+	namesLines.append(namesPrefix + " ".join(lineTokens))
+	namesLines.append(":telegram.irc.bridge 366 " + client.nick + " " + channel + " :End of /NAMES list.")
+	sendLinesToIrc(client, namesLines)
+
+
+def handleIrcWho(client, message):  # client requesting WHO
+	convertedGroupId = str(message.params[0].lstrip("#"))
+	whoPrefix = ":telegram.irc.bridge 352 " + client.nick + " " + message.params[0] + " "
+	whoLines = [whoPrefix + client.user + " " + client.host + " telegram.irc.bridge " + client.nick + " H :0 " + client.real]
+	memberTokens = lookupGroupMemberTokens(channelGroupId(message.params[0]))
+	if not memberTokens:
+		printLog("IRC", "WARNING! group cache for TG group " + str(convertedGroupId) + " nonexistent or empty, sending empty WHO reply")
+	for cachedUserId, memberToken in memberTokens:
+		whoLines.append(whoPrefix + str(cachedUserId) + " telegram.irc.bridge telegram.irc.bridge " + memberToken[1:] + " H" + memberToken[0] + " :0 TelegramUser")
+		if len(whoLines) >= ircReplyBatchLines:  # big groups go out in batches rather than as one enormous string
+			sendLinesToIrc(client, whoLines)
+			whoLines = []
+	whoLines.append(":telegram.irc.bridge 315 " + client.nick + " " + message.params[0] + " :End of /WHO list.")
+	sendLinesToIrc(client, whoLines)
+	printLog("IRC", "Client requested memberlist (WHO) of pseudochannel #" + str(convertedGroupId))
+
+
+def handleIrcMode(client, message):  # client trying to change MODEs
+	if message.params[0].startswith("#"):  # ... on a channel
+		if len(message.params) == 2:
+			# just checking or setting a channel mode of some kind, no targets specified
+
+			# various channel list checks
+			if message.params[1] == "+b":
+				sendToIrc(client, ":telegram.irc.bridge 368 " + client.nick + " " + message.params[0] + " :End of channel ban list")
+				printLog("IRC", "Sent empty ban list.")
+			if message.params[1] == "+e":
+				sendToIrc(client, ":telegram.irc.bridge 349 " + client.nick + " " + message.params[0] + " :End of channel exception list")
+				printLog("IRC", "Sent empty banexcept list.")
+			if message.params[1] == "+I":
+				sendToIrc(client, ":telegram.irc.bridge 347 " + client.nick + " " + message.params[0] + " :End of channel invite exception list")
+				printLog("IRC", "Sent empty invex list.")
+			if message.params[1] == "+g":
+				sendToIrc(client, ":telegram.irc.bridge 940 " + client.nick + " " + message.params[0] + " :End of channel spamfilter list")
+				printLog("IRC", "Sent empty spamfilter list.")
+
+			else:  # looks like it might be an actual mode change. better tell them to fuck off.
+				printLog("IRC", "Denied mode change.")
+				sendToIrc(client, ":telegram.irc.bridge 482 " + client.nick + " " + message.params[0] + " :You must have channel halfop access or above to set channel mode ")
+
+		else:  # ok it LOOKS like they're trying to set some kind of mode on the channel or someone. better just tell them to fuck themselves.
+			printLog("IRC", "Denied mode change (length check fail)")
+			sendToIrc(client, ":telegram.irc.bridge 482 " + client.nick + " " + message.params[0] + " :You must have channel halfop access or above to set channel mode ")  # but be kinda vague. this might be a problem with really convoluted bots that check 482 responses.
+		sendToIrc(client, ":telegram.irc.bridge 324 " + client.nick + " " + message.params[0] + " +nts")  # standard "no outside messages, no topic changes without ops, secret" mode line used by lots of ircds
+	elif message.params[0] == client.nick:  # setting modes on itself. just echo it back.
+		sendToIrc(client, ":" + client.nick + "!" + client.user + "@" + client.host + " MODE " + " ".join(message.params))
+		printLog("IRC", "Client set modes " + " ".join(message.params[1:]) + " on themself")
+	else:
+		printLog("IRC", "Client tried to set modes on another user. Ignoring. (" + message.command + " " + " ".join(message.params) + ")")
+
+
+def handleIrcStats(client, message):  # client asking for server statistics. whatever the query letter, they get the metrics
+	statsQuery = message.params[0] if message.params else "*"
+	statsLines = [":telegram.irc.bridge 249 " + client.nick + " :" + metricLine for metricLine in renderMetrics()]
+	statsLines.append(":telegram.irc.bridge 219 " + client.nick + " " + statsQuery + " :End of /STATS report")
+	for batchStart in range(0, len(statsLines), ircReplyBatchLines):
+		sendLinesToIrc(client, statsLines[batchStart:batchStart + ircReplyBatchLines])
+
+
+def handleIrcPrivmsg(client, message):  # client messaging something
+	destinationChatId = None
+	messageType = None
+	if message.params[0].startswith("#"):  # this is a channel/group/thing
+		groupId = channelGroupId(message.params[0])
+		if groupId is not None and groupId < 0:  # not a telegram chat at all (#foo) is ignored too
+			destinationChatId = str(groupId)
+			messageType = "Chan"
+			relayIrcChannelMessage(client, message)
+		else:
+			destinationChatId = None
+			messageType = None
+			return
+	else:  # okay, so it's not a channel. it's a direct message to another user.
+		cachedUserId, cachedUserDmsAllowed = lookupUserByName(message.params[0])
+		if cachedUserId is not None:  # found it. this is where it goes.
+			if cachedUserDmsAllowed:
+				destinationChatId = cachedUserId
+				messageType = "PM w/"
 			else:
 				destinationChatId = None
 				messageType = None
+				printLog("Compat WARNING", "Client attempted to DM a user who has not accepted DMs from the bot.")
 				return
-		else:  # okay, so it's not a channel. it's a direct message to another user.
-			for cachedUserId, cachedUserInfo in telegramCache["users"].items():
-				if cachedUserInfo[0] == str(line[1]).lower():  # found it. this is where it goes.
-					if cachedUserInfo[1]:
-						destinationChatId = cachedUserId
-						messageType = "PM w/"
-					else:
-						destinationChatId = None
-						messageType = None
-						printLog("Compat WARNING", "Client attempted to DM a user who has not accepted DMs from the bot.")
-						return
-
-		if destinationChatId is None:
-			return
-			# just ignore it.
-		outboundText = " ".join(line[2:]).lstrip(":")  # remove leading colon off our message if it exists...
-		outboundText = outboundText.replace("\x01NEWLINE\x01", "\n")  # outgoing newline support for clients that don't support just leaving lone \n's (opposing RFC considering \r\n being the only protocol line terminator)
-		if outboundText.startswith("\x01ACTION"):  # outgoing ACTION
-			outboundText = " ".join(outboundText.split(" ")[1:]).strip("\x01")  # strip ACTION and 0x01s.
-			if "\n" in outboundText:  # outgoing multi-line ACTION
-				outgoingRealText = ""
-				for outboundMultiLineText in outboundText.split("\n"):  # split and do our work.
-					if outboundMultiLineText != "":
-						printLog(" * IRC " + messageType + " " + str(line[1]).lower(), " * " + ircuser["nick"] + "|M " + outboundMultiLineText)
-						outgoingRealText = outgoingRealText + "*" + outboundMultiLineText + "*\n"  # wrap stars round each line in it
-				sendToTelegramChat(destinationChatId, outgoingRealText.rstrip("\n"))  # and ship it after trimming any stray newlines.
-			else:  # outgoing single-line ACTION
-				printLog(" * IRC " + messageType + " " + str(line[1]).lower(), " * " + ircuser["nick"] + " " + outboundText)
-				sendToTelegramChat(destinationChatId, "*" + outboundText + "*")  # nothing special here, just wrap in stars and send it.
-
-		else:  # outgoing regular message
-			if "\n" in outboundText:  # outgoing multi-line message
-				for outboundMultiLineText in outboundText.split("\n"):
-					printLog(" * IRC " + messageType + " " + str(line[1]).lower(), "<" + ircuser["nick"] + "|M> " + outboundMultiLineText)
-			else:  # outgoing single-line message
-				printLog(" * IRC " + messageType + " " + str(line[1]).lower(), "<" + ircuser["nick"] + "> " + outboundText)
-			sendToTelegramChat(destinationChatId, outboundText)  # shockingly, we can just send this as-is.
-
-	elif line[0] == "NOTICE":  # client noticing something
-		destinationChatId = None
-		messageType = None
-		if line[1].startswith("#"):  # this is a channel/group/thing
-			if int(line[1].lstrip("#")) < 0:  # only message negative-ID conversations as channels
-				destinationChatId = str(line[1].lstrip("#"))
-				messageType = "Chan"
+
+	if destinationChatId is None:
+		return
+		# just ignore it.
+	outboundText = message.textFrom(1)
+	outboundText = outboundText.replace("\x01NEWLINE\x01", "\n")  # outgoing newline support for clients that don't support just leaving lone \n's (opposing RFC considering \r\n being the only protocol line terminator)
+	logChannel = " * IRC " + messageType + " " + message.params[0].lower()
+	if outboundText.startswith("\x01ACTION"):  # outgoing ACTION
+		outboundText = " ".join(outboundText.split(" ")[1:]).strip("\x01")  # strip ACTION and 0x01s.
+		if "\n" in outboundText:  # outgoing multi-line ACTION
+			outgoingRealText = ""
+			for outboundMultiLineText in outboundText.split("\n"):  # split and do our work.
+				if outboundMultiLineText != "":
+					printLog(logChannel, " * %s|M %s", client.nick, outboundMultiLineText)
+					outgoingRealText = outgoingRealText + "*" + outboundMultiLineText + "*\n"  # wrap stars round each line in it
+			sendToTelegramChat(destinationChatId, outgoingRealText.rstrip("\n"))  # and ship it after trimming any stray newlines.
+		else:  # outgoing single-line ACTION
+			printLog(logChannel, " * %s %s", client.nick, outboundText)
+			sendToTelegramChat(destinationChatId, "*" + outboundText + "*")  # nothing special here, just wrap in stars and send it.
+
+	else:  # outgoing regular message
+		if "\n" in outboundText:  # outgoing multi-line message
+			for outboundMultiLineText in outboundText.split("\n"):
+				printLog(logChannel, "<%s|M> %s", client.nick, outboundMultiLineText)
+		else:  # outgoing single-line message
+			printLog(logChannel, "<%s> %s", client.nick, outboundText)
+		sendToTelegramChat(destinationChatId, outboundText)  # shockingly, we can just send this as-is.
+	countMetric("bridge_messages_total", 'direction="irc_to_telegram"')
+
+
+def handleIrcNotice(client, message):  # client noticing something
+	destinationChatId = None
+	messageType = None
+	if message.params[0].startswith("#"):  # this is a channel/group/thing
+		groupId = channelGroupId(message.params[0])
+		if groupId is not None and groupId < 0:  # only message negative-ID conversations as channels
+			destinationChatId = str(groupId)
+			messageType = "Chan"
+			relayIrcChannelMessage(client, message)
+		else:
+			destinationChatId = None
+			printLog("Compat WARNING", "Client attempted to notice a non-group conversation as a channel")
+	else:  # okay, so it's not a channel. it's a direct message to another user.
+		cachedUserId, cachedUserDmsAllowed = lookupUserByName(message.params[0])
+		if cachedUserId is not None:  # found it. this is where it goes.
+			if cachedUserDmsAllowed:
+				destinationChatId = cachedUserId
+				messageType = "PM w/"
 			else:
 				destinationChatId = None
-				printLog("Compat WARNING", "Client attempted to notice a non-group conversation as a channel")
-		else:  # okay, so it's not a channel. it's a direct message to another user.
-			for cachedUserId, cachedUserInfo in telegramCache["users"].items():
-				if cachedUserInfo[0] == str(line[1]).lower():  # found it. this is where it goes.
-					if cachedUserInfo[1]:
-						destinationChatId = cachedUserId
-						messageType = "PM w/"
-					else:
-						destinationChatId = None
-						printLog("Compat WARNING", "Client attempted to notice-DM a user who has not accepted DMs from the bot.")
-						return
-
-		if destinationChatId is None:
-			return
-			# just ignore it.
-		outboundText = " ".join(line[2:]).lstrip(":")  # remove leading colon off our message if it exists...
-		outboundText = outboundText.replace("\x01NEWLINE\x01", "\n")  # outgoing newline support for clients that don't support just leaving lone \n's (opposing RFC considering \r\n being the only protocol line terminator)
-		if "\n" in outboundText:  # outgoing multi-line NOTICE
-			for outboundMultiLineText in outboundText.split("\n"):
-				printLog(" * IRC " + messageType + " " + str(line[1]).lower(), "^" + ircuser["nick"] + "|M^ " + outboundMultiLineText)
-		else:  # regular single-line NOTICE
-			printLog(" * IRC " + messageType + " " + str(line[1]).lower(), "^" + ircuser["nick"] + "^ " + outboundText)
-		sendToTelegramChat(destinationChatId, "`[Notice] " + outboundText + "`", True)
+				printLog("Compat WARNING", "Client attempted to notice-DM a user who has not accepted DMs from the bot.")
+				return
 
-	else:  # other garbage info coming in. print here.
-		printLog("IRC", "GARBAGE: |" + " ".join(line) + "|")
+	if destinationChatId is None:
+		return
+		# just ignore it.
+	outboundText = message.textFrom(1)
+	outboundText = outboundText.replace("\x01NEWLINE\x01", "\n")  # outgoing newline support for clients that don't support just leaving lone \n's (opposing RFC considering \r\n being the only protocol line terminator)
+	logChannel = " * IRC " + messageType + " " + message.params[0].lower()
+	if "\n" in outboundText:  # outgoing multi-line NOTICE
+		for outboundMultiLineText in outboundText.split("\n"):
+			printLog(logChannel, "^%s|M^ %s", client.nick, outboundMultiLineText)
+	else:  # regular single-line NOTICE
+		printLog(logChannel, "^%s^ %s", client.nick, outboundText)
+	sendToTelegramChat(destinationChatId, outboundText, True, telegramPriorityControl, "[Notice] ")
+	countMetric("bridge_messages_total", 'direction="irc_to_telegram"')
+
+
+# command: ( handler, minimum number of parameters )
+ircCommandHandlers = {
+	"PING": (handleIrcPing, 0),
+	"PASS": (handleIrcPass, 1),
+	"USER": (handleIrcUser, 4),
+	"PONG": (handleIrcPong, 0),
+	"NICK": (handleIrcNick, 1),
+	"PART": (handleIrcPart, 1),
+	"KICK": (handleIrcKick, 2),
+	"REMOVE": (handleIrcRemove, 2),
+	"QUIT": (handleIrcQuit, 0),
+	"JOIN": (handleIrcJoin, 1),
+	"NAMES": (handleIrcNames, 1),
+	"WHO": (handleIrcWho, 1),
+	"MODE": (handleIrcMode, 1),
+	"PRIVMSG": (handleIrcPrivmsg, 2),
+	"NOTICE": (handleIrcNotice, 2),
+	"STATS": (handleIrcStats, 0),
+	"CAP": (handleIrcCap, 1)
+}
+ircRegistrationCommands = {"PASS", "NICK", "USER", "CAP", "PING", "PONG", "QUIT"}  # all a client may send before it's logged in
+
+
+class IrcLineFramer:
+	# incremental line framer over one reusable buffer, which the protocol has the socket read straight into.
+	# lines end in CRLF or a bare LF, can be split across any number of reads, and come back out as memoryview slices (no copies).
+	__slots__ = ("buffer", "view", "start", "end", "maxLineLength", "discarding")
+
+	def __init__(self, maxLineLength):
+		self.buffer = bytearray(max(maxLineLength * 2, 65536))  # always room for a partial line plus another maxLineLength
+		self.view = memoryview(self.buffer)
+		self.start = 0  # first byte of the line we haven't finished yet
+		self.end = 0  # one past the last byte received
+		self.maxLineLength = maxLineLength
+		self.discarding = False  # in the middle of an overlong line, dropping everything up to its end
+
+	def getBuffer(self):
+		# where the next read should go. slices handed out by lines() are only good until this is called again
+		if self.start:
+			remaining = self.end - self.start
+			self.view[:remaining] = self.view[self.start:self.end]  # only ever the one partial line
+			self.start = 0
+			self.end = remaining
+		return self.view[self.end:]
+
+	def lines(self, nbytes):
+		# nbytes more were read into getBuffer(). yields every line they completed, without the terminator
+		scanFrom = self.end
+		self.end += nbytes
+		while True:
+			lineEnd = self.buffer.find(b"\n", scanFrom, self.end)
+			if lineEnd == -1:
+				break
+			lineStart = self.start
+			self.start = scanFrom = lineEnd + 1
+			if self.discarding:
+				self.discarding = False
+				continue
+			if lineEnd > lineStart and self.buffer[lineEnd - 1] == 13:  # \r
+				lineEnd -= 1
+			if lineEnd - lineStart > self.maxLineLength:
+				printLog("IRC WARNING", "Dropped an overlong line from IRC (" + str(lineEnd - lineStart) + " bytes)")
+				continue
+			if lineEnd > lineStart:
+				yield self.view[lineStart:lineEnd]
+		if self.discarding:
+			self.start = self.end  # still no end to the overlong line
+		elif self.end - self.start > self.maxLineLength:
+			# no end in sight. throw away what we have and skip until the next terminator
+			printLog("IRC WARNING", "Dropping an overlong line from IRC")
+			self.start = self.end
+			self.discarding = True
+
+
+class IrcClientProtocol(asyncio.BufferedProtocol):
+	# one connected IRC client, with its own nick and channels. everything in here runs on the IRC event loop
+	def __init__(self):
+		self.transport = None
+		self.lastActivity = monotonic()
+		self.pingTimer = None
+		self.framer = IrcLineFramer(telegramConfig["ircMaxLineLength"])
+		self.user = None
+		self.nick = None
+		self.real = None
+		self.host = None
+		self.password = None  # from PASS, checked when registration completes
+		self.registered = False
+		self.channels = set()
+		self.pendingJoins = {}  # "#chatid" -> timer, for JOINs whose NAMES waits on the group's warm-up
+		self.caps = set()  # IRCv3 capabilities the client asked for
+		self.capNegotiating = False
+		self.sendBuffer = []  # encoded lines waiting for the next flush
+		self.pendingLatencies = []  # ( metric name, unix time ) to observe once sendBuffer has been written
+		self.flushScheduled = False
+		self.writingPaused = False
+
+	def connection_made(self, transport):
+		self.transport = transport
+		ircClients.add(self)
+		transport.set_write_buffer_limits(high=telegramConfig["ircWriteBufferBytes"])
+		printLog("IRC", "Client attempting connection from %s...", transport.get_extra_info("peername"))
+		self.pingTimer = ircLoop.call_later(telegramConfig["ircPingIntervalSeconds"], self.keepalive)
+
+	def queueOutput(self, data):
+		# everything queued before the loop gets back around to flushOutput goes out in one write
+		if self.transport is None or self.transport.is_closing():
+			return
+		self.sendBuffer.append(data)
+		if self.writingPaused and len(self.sendBuffer) > telegramConfig["ircSendQueueLimit"]:
+			# it's stopped reading and we're not holding everyone else up for it
+			printLog("IRC WARNING", "Client %s isn't keeping up! Dropping it (SendQ exceeded).", self.nick)
+			self.sendBuffer.clear()
+			self.pendingLatencies.clear()
+			self.transport.abort()
+			return
+		if not self.flushScheduled:
+			self.flushScheduled = True
+			ircLoop.call_soon(self.flushOutput)
+
+	def flushOutput(self):
+		# the one place that writes to this client. write errors surface through connection_lost
+		self.flushScheduled = False
+		if self.writingPaused or not self.sendBuffer:
+			return  # resume_writing will call us again
+		if self.transport is not None and not self.transport.is_closing():
+			writtenData = b"".join(self.sendBuffer)
+			self.transport.write(writtenData)
+			countMetric("bridge_irc_lines_written_total", "", writtenData.count(b"\n"))  # a chunk can be a whole NAMES or WHO reply
+			for name, sentAt in self.pendingLatencies:
+				observeSince(name, sentAt)
+		self.sendBuffer.clear()
+		self.pendingLatencies.clear()
+
+	def observeOnWrite(self, name, sentAt):
+		# latency up to the point what's queued right now reaches the socket. if it already has, that's now
+		if self.sendBuffer:
+			self.pendingLatencies.append((name, sentAt))
+		elif not self.transport.is_closing():
+			observeSince(name, sentAt)
+
+	def disconnect(self, reason):
+		# tell the client why, then hang up once that's been written
+		self.queueOutput(("ERROR :Closing link (" + reason + ")\r\n").encode("utf-8"))
+		self.flushOutput()
+		self.transport.close()
+
+	def get_buffer(self, sizehint):
+		return self.framer.getBuffer()
+
+	def buffer_updated(self, nbytes):
+		self.lastActivity = monotonic()
+		# now we parse our received data. Hopefully. a whole pipelined burst of commands is framed in a single pass
+		for rawline in self.framer.lines(nbytes):
+			if self.transport.is_closing():
+				return
+			try:
+				line = str(rawline, "utf-8")  # decode
+			except UnicodeDecodeError:
+				printLog("IRC", "ERROR: Could not decode a line from IRC.")
+				continue
+			try:
+				parseIrcMessages(self, line)  # and parse it.
+			except Exception:
+				printLog("IRC ERROR", "Error in parsing function! Error as follows: " + str(sys.exc_info()[1]))
+
+	def keepalive(self):
+		# PING the client every so often, and drop it if it hasn't said anything in two intervals
+		pingInterval = telegramConfig["ircPingIntervalSeconds"]
+		if monotonic() - self.lastActivity > pingInterval * 2:
+			printLog("IRC", "Client %s ping timeout.", self.nick)
+			self.transport.close()
+			return
+		sendToIrc(self, "PING :telegram.irc.bridge")
+		self.pingTimer = ircLoop.call_later(pingInterval, self.keepalive)
+
+	def pause_writing(self):
+		# the client has stopped reading. hold everything in sendBuffer, and stop taking commands we'd only have to answer
+		self.writingPaused = True
+		self.transport.pause_reading()
+
+	def resume_writing(self):
+		self.writingPaused = False
+		self.transport.resume_reading()
+		self.flushOutput()
+
+	def connection_lost(self, exc):
+		# the telegram side keeps running. forget the client, and if it was the last one, buffer chat until somebody logs in again
+		if self.pingTimer is not None:
+			self.pingTimer.cancel()
+		self.sendBuffer.clear()
+		self.pendingLatencies.clear()
+		ircClients.discard(self)
+		for channel in tuple(self.channels):
+			leaveIrcChannel(self, channel)
+		with ircReplayLock:
+			ircRegisteredClients.discard(self)
+			remainingClients = len(ircRegisteredClients)
+		printLog("IRC", ("A socket error occured on client %s" if exc is not None else "Client %s closed the connection") + ".", self.nick)
+		if not remainingClients:
+			printLog("IRC", "No clients left. Buffering chat until one logs in.")
+
+
+async def startIrcServer():
+	# keep trying to bind without blocking anything else on the loop. backs off so a stuck port doesn't spam the log
+	printLog("IRC", "Attempting to bind socket...")
+	retryDelay = 2
+	while True:
+		try:
+			ircServer = await ircLoop.create_server(IrcClientProtocol, telegramSecretConfig["ircHost"], telegramSecretConfig["ircPort"], reuse_address=True)
+			printLog("IRC", "Socket bound and listening.")
+			return ircServer
+		except OSError as error:
+			printLog("IRC", "Failed to bind socket (" + str(error) + ")... retrying in " + str(retryDelay) + " seconds!")
+			await asyncio.sleep(retryDelay)
+			retryDelay = min(retryDelay * 2, 60)
 
 
 printLog("System", "Setting initial variables...")
 
-telegramCache = loadCache()
 telegramConfig = loadConfig()
+configureLogging(telegramConfig)
+cacheStore = openCacheStore()
+telegramCache = cacheStore.load()
 telegramSecretConfig = loadOrCreateSecretConfig()
 if telegramSecretConfig is None:
 	sys.exit(255)
 
 printLog("System", "Initializing Telegram interface...")
 
-conn = None
-updater = Updater(token=telegramSecretConfig["telegramToken"], use_context=True)
+updater = Updater(token=telegramSecretConfig["telegramToken"], base_url=telegramSecretConfig["telegramApiBaseUrl"], use_context=True)
 dispatcher = updater.dispatcher
-telegramBotInterface = Bot(token=telegramSecretConfig["telegramToken"])
-logging.basicConfig(format="[%(asctime)s] [*%(name)s %(levelname)s] %(message)s", level=logging.INFO)
-ircuser = {
-	"user": None,
-	"nick": None,
-	"real": None,
-	"host": None,
-	"welcome": None,
-	"channels": []
-}
-conn, addr = None, None
+telegramUpdatesStarted = False
+webhookMaxBodyBytes = 16 * 1024 * 1024  # recorded batches can be big, telegram's own posts are not
+telegramBotInterface = Bot(token=telegramSecretConfig["telegramToken"], base_url=telegramSecretConfig["telegramApiBaseUrl"], request=newTelegramRequest())
+ircSupportedCaps = ["server-time"]
+ircReplayBuffers = {}  # destination -> deque of ( unix time, line ) held for a client that isn't logged in
+ircReplayLock = threading.Lock()
+ircLoop = asyncio.new_event_loop()  # the IRC side lives entirely on this loop, on the main thread
+asyncio.set_event_loop(ircLoop)
+ircLoopThreadId = threading.get_ident()
+ircClients = set()  # every connected IrcClientProtocol
+ircRegisteredClients = set()  # ... the ones that are logged in. changed under ircReplayLock
+ircChannelClients = {}  # "#chatid" -> set of clients that joined it. telegram output goes only where it's wanted. changed under ircReplayLock
+ircSendSlots = threading.BoundedSemaphore(telegramConfig["ircSendQueueLimit"])  # how many chunks other threads may have in flight
+ircModesPerLine = 12  # advertised as MODES=, and how membership MODE changes are packed
+ircWelcomeBurst = buildIrcWelcomeBurst()
+ircLineLimit = 510  # 512 bytes, less the CRLF
+ircReplyBatchLines = 500  # lines per chunk when streaming out long replies
+outboundTextPatterns = {}  # ( stripAtSigns, convertMentions, escapeForCode ) -> compiled rewriteOutboundText pattern
+outboundTextReplacements = {"\x01NEWLINE\x01": "\n", "@": ""}  # fixed rewrites. code span characters get a backslash
+ircTagUnescapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}  # IRCv3 message tag value escapes
+cacheLock = threading.RLock()
+usernameIndex = {}  # "lowercaseusername": userId, for routing DMs from IRC without scanning every user
+rebuildCacheIndexes()
+adminCache = {}  # "groupId": [ fetchedAtMonotonic, { userId: usernameString } or None if it couldn't be fetched, memberCount or None ]
+adminCacheLock = threading.Lock()
+adminRefreshQueue = queue.PriorityQueue()  # ( priority, queuedAtMonotonic, "groupId" )
+adminRefreshPending = {}  # "groupId": priority it's queued at
+adminRefreshBucket = TokenBucket(telegramConfig["groupRefreshRequestsPerSecond"], telegramConfig["groupRefreshRequestsPerSecond"])
+telegramPriorityControl = 0  # NOTICEs and bridge control replies. jump ahead of...
+telegramPriorityBulk = 1  # ... regular PRIVMSG traffic
+telegramOutbox = {}  # "chatId": { "queues": [ controlDeque, bulkDeque ], "bucket": TokenBucket, ...stats }
+telegramOutboxPending = set()  # chats with anything queued
+telegramOutboxDepth = 0
+telegramSendsInFlight = 0
+telegramOutboxStats = {"dropped": 0, "coalesced": 0}
+telegramMessageLengthLimit = 4096  # telegram refuses anything longer
+telegramOutboxCondition = threading.Condition()
+# everything that can send messages: the main bot, then any extra bots from the sender pool. each gets its own overall flood limit
+telegramSenders = [{"name": "main bot", "bot": telegramBotInterface, "bucket": TokenBucket(telegramConfig["telegramGlobalMessagesPerSecond"], telegramConfig["telegramGlobalMessagesPerSecond"])}]
+for extraToken in telegramSecretConfig["telegramExtraTokens"]:
+	telegramSenders.append({"name": "pool bot " + str(len(telegramSenders)), "bot": Bot(token=extraToken, base_url=telegramSecretConfig["telegramApiBaseUrl"], request=newTelegramRequest()), "bucket": TokenBucket(telegramConfig["telegramGlobalMessagesPerSecond"], telegramConfig["telegramGlobalMessagesPerSecond"])})
+if len(telegramSenders) > 1:
+	printLog("Telegram", "Sending through %d bots", len(telegramSenders))
+inboundChats = {}  # chatId -> deque of ( update, queuedAt ) waiting for, or being worked on by, a telegramInbound worker
+inboundReadyChats = deque()  # chats with updates queued and no worker on them, in the order they became ready
+inboundUpdateOrder = deque()  # update ids not yet handled, oldest first, and...
+inboundFinishedIds = set()  # ... the ones among them that are done, waiting on something older
+inboundUpdatesQueued = 0
+inboundUpdatesInFlight = 0
+inboundCondition = threading.Condition()
+inboundWorkerState = threading.local()  # dispatching is set on the workers, so bridge_routeupdate lets their updates through
+telegramSenderExcludeSeconds = 3600  # a bot that got Unauthorized in a group isn't tried there again for this long
+cacheDirtyCount = 0  # changes made to telegramCache since it was last written out
+cacheOffsetDirty = False  # lastUpdateId moved. written with the next flush, but doesn't count towards cacheFlushDirtyThreshold
+cacheDirtyUsers = set()  # ... and which users and ( group, user ) memberships they touched
+cacheDirtyMemberships = set()
+cacheLoadedGroups = set()  # groups the sqlite store has already pulled into the hot set
+cacheFlushEvent = threading.Event()
+cacheFlushLock = threading.Lock()
+cacheFlushStats = {"flushes": 0, "changes": 0, "lastFlushSeconds": 0.0, "totalFlushSeconds": 0.0, "maxFlushSeconds": 0.0}
+bridgeFirstMessageSeconds = None  # startup to the first TG->IRC message
+metricsLock = threading.Lock()
+metricsCounters = {}  # ( name, labels ) -> count
+metricsHistograms = {}  # ( name, labels ) -> MetricsHistogram
+metricsHistogramBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds
 
 bridge_action_handler = CommandHandler("me", bridge_alltext)  # for properly sending IRC-style ACTIONs
 dispatcher.add_handler(bridge_action_handler)
@@ -700,51 +2542,31 @@ dispatcher.add_handler(bridge_bridgecfg_handler)
 bridge_text_handler = MessageHandler(Filters.text, bridge_alltext)  # all other text that's sent to the bot
 dispatcher.add_handler(bridge_text_handler)
 
+bridge_chatmember_handler = ChatMemberHandler(bridge_chatmember, ChatMemberHandler.ANY_CHAT_MEMBER)  # admin promotions/demotions and joins/leaves
+dispatcher.add_handler(bridge_chatmember_handler)
+
 # needs to be absolutely the last handler registered.
 bridge_allcmds_handler = MessageHandler(Filters.command, bridge_alltext)  # all other slash-commands sent to the bot
 dispatcher.add_handler(bridge_allcmds_handler)
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as irc_socket:
-	printLog("IRC", "Attempting to bind socket...")
-	socketBound = False
-	while not socketBound:
-		try:
-			irc_socket.bind((telegramSecretConfig["ircHost"], telegramSecretConfig["ircPort"]))
-			irc_socket.listen()
-			socketBound = True
-			printLog("IRC", "Socket bound and listening.")
-		except:
-			printLog("IRC", "Failed to bind socket... retrying in 2 seconds!")
-			sleep(2)
-			pass
-	# and now, we wait.
-	printLog("IRC (Blocked)", "Now waiting for client connection...")
-	conn, addr = irc_socket.accept()
-	with conn:
-		printLog("IRC", "Client attempting connection...")
-		while True:
-			try:
-				data = conn.recv(4096)
-			except:  # catch all errors and just exit
-				shutdownBridge(irc_socket, "IRC", "A socket error occured. Shutting down.", 254)
-			if not data:
-				shutdownBridge(irc_socket, "IRC", "A socket error occured. Shutting down.", 253)
-			# now we parse our received data. Hopefully.
-			data = data.split(b'\r\n')  # because some clients don't follow RFC, and send USER and NICK on the same line that's done to avoid the NICK/USER connection initialization deadlocking that does happen on big IRCds
-			for rawline in data:
-				# print(str(rawline))
-				try:
-					line = rawline.decode("utf-8")  # decode
-				except UnicodeDecodeError:
-					printLog("IRC", "ERROR: Could not decode a line from IRC.")
-					continue
-				if line == "" or line is None:  # make sure it's not just garbage data
-					continue  # empty line. skip.
-				line = line.split(" ")  # ok NOW split it
-				try:
-					parseIrcMessages(line)  # and parse it.
-				except:
-					printLog("IRC ERROR", "Error in parsing function! Error as follows: " + sys.exc_info()[0])
-					pass
-
-shutdownBridge(None, "CRITICAL ERROR", "Socket was closed! Exiting bridge!", 0)
+bridge_routeupdate_handler = TypeHandler(Update, bridge_routeupdate)  # ahead of everything else, hands updates to the telegramInbound workers
+dispatcher.add_handler(bridge_routeupdate_handler, group=-1)
+
+for refreshWorker in range(max(1, telegramConfig["groupRefreshWorkers"])):
+	threading.Thread(target=adminCacheRefresher, name="adminCacheRefresher" + str(refreshWorker), daemon=True).start()
+warmUpGroups()
+threading.Thread(target=cachePersister, name="cachePersister", daemon=True).start()
+for senderWorker in range(max(1, telegramConfig["telegramSendWorkers"])):
+	threading.Thread(target=telegramSender, name="telegramSender" + str(senderWorker), daemon=True).start()
+for inboundWorker in range(max(1, telegramConfig["telegramInboundWorkers"])):
+	threading.Thread(target=telegramInbound, name="telegramInbound" + str(inboundWorker), daemon=True).start()
+startMetricsServer()
+ircLoop.add_signal_handler(signal.SIGTERM, shutdownBridge, None, "System", "Received SIGTERM, exiting.", 0)
+ircLoop.add_signal_handler(signal.SIGINT, shutdownBridge, None, "System", "Received SIGINT, exiting.", 0)
+
+ircLoop.run_until_complete(startIrcServer())
+# and now, we wait.
+printLog("IRC", "Now waiting for client connection...")
+ircLoop.run_forever()
+
+shutdownBridge(None, "CRITICAL ERROR", "IRC event loop stopped! Exiting bridge!", 0)